@@ -0,0 +1,84 @@
+"""
+Checks each controller's vectorized BatchController against one scalar Controller per row in
+BatchedTinyPhysicsSimulator (costs and histories must match exactly), and times the controller phase of both.
+
+  python -m benchmarks.bench_batch_controllers --data_path ./data --batch_size 32
+
+Runs on synthetic segments unless --data_path is given. Exits 1 on the first mismatch. Run from the repository root.
+"""
+import argparse
+import copy
+import importlib
+import sys
+import tempfile
+import numpy as np
+
+from pathlib import Path
+from time import perf_counter
+
+from benchmarks.synthetic import write_segments
+from tinyphysics import BatchedTinyPhysicsSimulator, get_model
+
+CONTROLLERS = ['pid', 'tweakedPid', 'zero', 'controlTree', 'feedforwardPid']
+
+
+def make_controllers(controller_type: str, batch_size: int, rng: np.random.RandomState):
+  module = importlib.import_module(f'controllers.{controller_type}')
+  if controller_type == 'feedforwardPid':
+    # a different gain set per row, with every feed-forward term on
+    gains = {name: rng.uniform(-0.3, 0.3, batch_size) for name in module.GAIN_NAMES}
+    return [module.Controller(**{name: float(g[b]) for name, g in gains.items()}) for b in range(batch_size)], module.BatchController(batch_size, **gains)
+  if controller_type != 'controlTree':
+    return [module.Controller() for _ in range(batch_size)], module.BatchController(batch_size)
+  # a mix of distinct trees and copies, so both the scalar and the shared vectorized programs run
+  distinct = [module.Controller(maxDepth=int(rng.randint(1, 6))) for _ in range(max(1, batch_size // 2))]
+  trees = [distinct[rng.randint(len(distinct))] for _ in range(batch_size)]
+  return [copy.deepcopy(tree) for tree in trees], module.BatchController(trees=trees)
+
+
+def timed_rollout(sim: BatchedTinyPhysicsSimulator):
+  control_seconds = 0.0
+  control_step = sim.control_step
+
+  def timed_control_step(*args):
+    nonlocal control_seconds
+    start = perf_counter()
+    control_step(*args)
+    control_seconds += perf_counter() - start
+
+  sim.control_step = timed_control_step
+  start = perf_counter()
+  costs = sim.rollout()
+  return costs, control_seconds, perf_counter() - start
+
+
+def same(sim_a: BatchedTinyPhysicsSimulator, costs_a, sim_b: BatchedTinyPhysicsSimulator, costs_b) -> bool:
+  return (costs_a == costs_b and np.array_equal(sim_a.action_history, sim_b.action_history)
+          and np.array_equal(sim_a.current_lataccel_history, sim_b.current_lataccel_history))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--model_path", type=str, default="./models/tinyphysics.onnx")
+  parser.add_argument("--data_path", type=str, default=None)
+  parser.add_argument("--batch_size", type=int, default=32)
+  parser.add_argument("--controllers", nargs='+', default=CONTROLLERS)
+  args = parser.parse_args()
+
+  model = get_model(args.model_path)
+  rng = np.random.RandomState(0)
+  with tempfile.TemporaryDirectory() as tmp:
+    data_path = Path(args.data_path or write_segments(tmp, args.batch_size))
+    files = [str(f) for f in sorted(data_path.iterdir())[:args.batch_size]]
+    failures = 0
+    for controller_type in args.controllers:
+      scalar, batched = make_controllers(controller_type, len(files), rng)
+      loop_sim = BatchedTinyPhysicsSimulator(model, files, controllers=scalar)
+      batch_sim = BatchedTinyPhysicsSimulator(model, files, controllers=batched)
+      loop_costs, loop_control, loop_total = timed_rollout(loop_sim)
+      batch_costs, batch_control, batch_total = timed_rollout(batch_sim)
+      ok = same(loop_sim, loop_costs, batch_sim, batch_costs)
+      failures += not ok
+      print(f"{controller_type:<16}{'OK' if ok else 'MISMATCH':<10}controller phase: loop {loop_control:>7.3f} s  batch {batch_control:>7.3f} s   "
+            f"rollout: loop {loop_total:>7.2f} s  batch {batch_total:>7.2f} s")
+  sys.exit(1 if failures else 0)
@@ -0,0 +1,80 @@
+"""
+Import-time benchmark: wall time of importing each entry module in a fresh interpreter, and which heavy
+dependencies the import pulls in.
+
+  python -m benchmarks.bench_import --output imports.json
+  python -m benchmarks.bench_import --baseline imports.json   # exits 1 on regression
+
+Every pool worker imports tinyphysics, so its import time is paid once per worker. Run from the repository root.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import numpy as np
+
+from pathlib import Path
+
+MODULES = ['tinyphysics', 'rollout', 'genetics', 'eval']
+# deferred until used; importing one of them at module load is a regression
+# (zipfile is not tracked: tqdm already imports it through importlib.metadata)
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'pandas', 'urllib.request', 'sqlite3']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [name for name in {heavy!r} if name in sys.modules]]))
+"""
+
+
+def measure(module: str, repeats: int) -> dict:
+  times, heavy = [], []
+  for _ in range(repeats):
+    out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)], check=True, capture_output=True, text=True).stdout
+    seconds, heavy = json.loads(out.strip().splitlines()[-1])
+    times.append(seconds)
+  return {'module': module, 'median_ms': float(np.median(times) * 1e3), 'min_ms': float(np.min(times) * 1e3), 'heavy_modules': heavy}
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+  regressions = []
+  for name, result in current['results'].items():
+    if name not in baseline['results']:
+      continue
+    base = baseline['results'][name]
+    change = (result['median_ms'] - base['median_ms']) / base['median_ms']
+    if change > tolerance:
+      regressions.append(f"{name} median_ms: {base['median_ms']:.1f} -> {result['median_ms']:.1f} ({change:+.1%})")
+    for heavy in sorted(set(result['heavy_modules']) - set(base['heavy_modules'])):
+      regressions.append(f"{name} now imports {heavy}")
+  return regressions
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--modules", nargs='+', default=MODULES)
+  parser.add_argument("--repeats", type=int, default=5)
+  parser.add_argument("--output", type=str, default=None)
+  parser.add_argument("--baseline", type=str, default=None)
+  parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative import-time growth")
+  args = parser.parse_args()
+
+  results = {}
+  for module in args.modules:
+    results[module] = measure(module, args.repeats)
+    print(f"{module:<16}{results[module]['median_ms']:>10.1f} ms   heavy: {', '.join(results[module]['heavy_modules']) or '-'}", file=sys.stderr)
+  report = {'meta': {'python': sys.version.split()[0], 'repeats': args.repeats}, 'results': results}
+
+  out = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    Path(args.output).write_text(out + "\n")
+  else:
+    print(out)
+
+  if args.baseline:
+    regressions = compare(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+    for regression in regressions:
+      print(f"REGRESSION {regression}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,147 @@
+"""
+Simulator throughput benchmark: rollouts/sec, steps/sec and peak RSS per (mode, controller).
+
+  python -m benchmarks.bench_rollouts --output bench.json
+  python -m benchmarks.bench_rollouts --baseline bench.json   # exits 1 on regression
+
+Runs on synthetic segments unless --data_path is given. Every case runs in a fresh interpreter so
+peak RSS is per case. Run from the repository root.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+from functools import partial
+from pathlib import Path
+from time import perf_counter
+
+from benchmarks.synthetic import write_segments
+
+MODES = ['single', 'multiprocess', 'batched']
+CONTROLLERS = ['pid', 'zero']
+# metric -> +1 if higher is better, -1 if lower is better
+METRICS = {'rollouts_per_sec': 1, 'steps_per_sec': 1, 'peak_rss_mb': -1}
+
+
+def peak_rss_mb() -> float:
+  # ru_maxrss is in KB on Linux and bytes on macOS
+  scale = 1 if sys.platform == 'darwin' else 1024
+  usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  return usage * scale / 2**20
+
+
+def run_case(mode: str, controller: str, data_path: str, model_path: str, num_segs: int, workers: int, batch_size: int) -> dict:
+  from tinyphysics import CONTEXT_LENGTH, RolloutPool, run_batched_rollout, run_rollout
+
+  # rollouts are seeded from the segment path, so run relative to the data directory's parent to keep
+  # seeds (and costs) independent of where the synthetic segments were written
+  model_path = str(Path(model_path).resolve())
+  data_path = Path(data_path).resolve()
+  os.chdir(data_path.parent)
+  files = sorted(Path(data_path.name).iterdir())[:num_segs]
+  start = perf_counter()
+  if mode == 'single':
+    results = [run_rollout(f, controller, model_path) for f in files]
+  elif mode == 'multiprocess':
+    with RolloutPool(model_path, max_workers=workers) as pool:
+      results = pool.map(partial(run_rollout, controller_type=controller, model_path=model_path), files, chunksize=max(1, len(files) // (4 * workers)))
+  elif mode == 'batched':
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    results = [result for batch in batches for result in run_batched_rollout(batch, controller, model_path)]
+  else:
+    raise ValueError(f"unknown mode {mode}")
+  seconds = perf_counter() - start
+
+  steps = sum(len(result[2]) - CONTEXT_LENGTH for result in results)
+  return {
+    'mode': mode,
+    'controller': controller,
+    'segments': len(files),
+    'seconds': seconds,
+    'rollouts_per_sec': len(files) / seconds,
+    'steps_per_sec': steps / seconds,
+    'peak_rss_mb': peak_rss_mb(),
+    # rollouts are deterministic, so any change here is a behaviour change rather than noise
+    'mean_total_cost': float(np.mean([result[0]['total_cost'] for result in results])),
+  }
+
+
+def run_suite(args, data_path: str) -> dict:
+  results = {}
+  for mode in args.modes:
+    for controller in args.controllers:
+      cmd = [sys.executable, '-m', 'benchmarks.bench_rollouts', '--case', mode, controller, '--data_path', data_path,
+             '--model_path', args.model_path, '--num_segs', str(args.num_segs), '--workers', str(args.workers), '--batch_size', str(args.batch_size)]
+      out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+      result = json.loads(out.strip().splitlines()[-1])
+      results[f"{mode}/{controller}"] = result
+      print(f"{mode + '/' + controller:<24}{result['rollouts_per_sec']:>10.2f} rollouts/s{result['steps_per_sec']:>12.0f} steps/s{result['peak_rss_mb']:>10.1f} MB", file=sys.stderr)
+  return {
+    'meta': {
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'num_segs': args.num_segs,
+      'workers': args.workers,
+      'batch_size': args.batch_size,
+    },
+    'results': results,
+  }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+  regressions = []
+  for name, result in current['results'].items():
+    if name not in baseline['results']:
+      continue
+    base = baseline['results'][name]
+    for metric, direction in METRICS.items():
+      change = (result[metric] - base[metric]) / base[metric]
+      if direction * change < -tolerance:
+        regressions.append(f"{name} {metric}: {base[metric]:.2f} -> {result[metric]:.2f} ({change:+.1%})")
+    if result['segments'] == base['segments'] and not np.isclose(result['mean_total_cost'], base['mean_total_cost'], rtol=1e-9):
+      regressions.append(f"{name} mean_total_cost: {base['mean_total_cost']:.6f} -> {result['mean_total_cost']:.6f}")
+  return regressions
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--model_path", type=str, default="./models/tinyphysics.onnx")
+  parser.add_argument("--data_path", type=str, default=None, help="segment directory; synthetic segments are generated if omitted")
+  parser.add_argument("--num_segs", type=int, default=8)
+  parser.add_argument("--workers", type=int, default=os.cpu_count())
+  parser.add_argument("--batch_size", type=int, default=8)
+  parser.add_argument("--modes", nargs='+', default=MODES, choices=MODES)
+  parser.add_argument("--controllers", nargs='+', default=CONTROLLERS)
+  parser.add_argument("--output", type=str, default=None)
+  parser.add_argument("--baseline", type=str, default=None)
+  parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown / memory growth")
+  parser.add_argument("--case", nargs=2, metavar=('MODE', 'CONTROLLER'), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.case:
+    print(json.dumps(run_case(*args.case, args.data_path, args.model_path, args.num_segs, args.workers, args.batch_size)))
+    sys.exit(0)
+
+  with tempfile.TemporaryDirectory() as tmp:
+    data_path = args.data_path or str(write_segments(Path(tmp) / 'data', args.num_segs))
+    report = run_suite(args, data_path)
+
+  out = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    Path(args.output).write_text(out + "\n")
+  else:
+    print(out)
+
+  if args.baseline:
+    regressions = compare(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+    for regression in regressions:
+      print(f"REGRESSION {regression}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
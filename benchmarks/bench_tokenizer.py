@@ -0,0 +1,62 @@
+"""
+Checks LataccelTokenizer.encode against np.digitize(clip(value), bins, right=True) and times both.
+tests/test_tokenizer.py runs the edge sweep in CI; this script adds the exhaustive float32 sweep and timings.
+
+  python -m benchmarks.bench_tokenizer                 # every bin edge +- 64 ULPs, midpoints, specials, random values
+  python -m benchmarks.bench_tokenizer --all_float32   # additionally every float32 in the clip range and beyond
+
+Exits 1 on the first mismatch. Run from the repository root.
+"""
+import argparse
+import sys
+import numpy as np
+
+from timeit import timeit
+
+from tests.test_tokenizer import edge_values, reference
+from tinyphysics import LATACCEL_RANGE, LataccelTokenizer
+
+
+def check(tokenizer: LataccelTokenizer, values: np.ndarray, scalar: bool = True) -> int:
+  expected = reference(tokenizer, values)
+  mismatches = np.flatnonzero(tokenizer.encode(values) != expected)
+  # batched [B, T] inputs go through the same code as 1-d ones, but check the shape handling too
+  mismatches = np.union1d(mismatches, np.flatnonzero(tokenizer.encode(values.reshape(-1, 1)).ravel() != expected))
+  if scalar:
+    mismatches = np.union1d(mismatches, [i for i, value in enumerate(values.tolist()) if tokenizer.encode(value) != expected[i]])
+  for i in mismatches[:10]:
+    print(f"MISMATCH value={values[i]!r}: encode={tokenizer.encode(values[i])} digitize={expected[i]}", file=sys.stderr)
+  return len(mismatches)
+
+
+def all_float32(chunk_bits: int = 24):
+  # every float32 bit pattern, in chunks, as float64 values
+  for start in range(0, 2**32, 2**chunk_bits):
+    # signaling NaN patterns raise an invalid-value warning when widened
+    with np.errstate(invalid='ignore'):
+      yield (np.arange(2**chunk_bits, dtype=np.uint32) + np.uint32(start)).view(np.float32).astype(np.float64)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--ulps", type=int, default=64)
+  parser.add_argument("--random", type=int, default=10**6)
+  parser.add_argument("--all_float32", action='store_true')
+  args = parser.parse_args()
+
+  tokenizer = LataccelTokenizer()
+  rng = np.random.RandomState(0)
+  failures = check(tokenizer, edge_values(tokenizer, args.ulps))
+  failures += check(tokenizer, rng.uniform(LATACCEL_RANGE[0] - 1, LATACCEL_RANGE[1] + 1, args.random), scalar=False)
+  failures += check(tokenizer, rng.uniform(LATACCEL_RANGE[0] - 1, LATACCEL_RANGE[1] + 1, 10**4))
+  if args.all_float32:
+    for values in all_float32():
+      failures += check(tokenizer, values, scalar=False)
+  print(f"{'OK' if not failures else f'{failures} mismatches'}: encode matches np.digitize(right=True)")
+
+  step, window, batch = rng.uniform(-6, 6, 8), rng.uniform(-6, 6, 20), rng.uniform(-6, 6, (32, 20))
+  for name, values in [('scalar', 0.3), ('[8]', step), ('[20]', window), ('[32, 20]', batch)]:
+    old = timeit(lambda: reference(tokenizer, values), number=10000) / 10000 * 1e6
+    new = timeit(lambda: tokenizer.encode(values), number=10000) / 10000 * 1e6
+    print(f"{name:<10}digitize {old:>8.2f} us   encode {new:>8.2f} us")
+  sys.exit(1 if failures else 0)
@@ -0,0 +1,48 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from typing import Union
+
+SEGMENT_STEPS = 600
+STEER_LOGGED_STEPS = 100  # steerCommand is only logged before control starts, NaN afterwards
+
+
+def generate_segment(seed: int, num_steps: int = SEGMENT_STEPS) -> pd.DataFrame:
+  """
+  A synthetic segment with the same columns as the dataset CSVs, so benchmarks run without downloading it.
+  """
+  rng = np.random.default_rng(seed)
+  t = np.arange(num_steps) / 10
+  v_ego = np.clip(20 + np.cumsum(rng.normal(0, 0.05, num_steps)), 0, None)
+  a_ego = np.gradient(v_ego, 0.1)
+  roll = 0.02 * np.sin(t / 7 + rng.uniform(0, 2 * np.pi))
+  target = rng.uniform(0.5, 2.0) * np.sin(t / rng.uniform(2, 8)) + rng.normal(0, 0.05, num_steps)
+  steer = np.full(num_steps, np.nan)
+  steer[:STEER_LOGGED_STEPS] = -0.3 * target[:STEER_LOGGED_STEPS] + rng.normal(0, 0.02, STEER_LOGGED_STEPS)
+  return pd.DataFrame({
+    't': t,
+    'vEgo': v_ego,
+    'aEgo': a_ego,
+    'roll': roll,
+    'targetLateralAcceleration': target,
+    'steerCommand': steer,
+  })
+
+
+def write_segments(out_dir: Union[str, Path], num_segs: int, seed: int = 0, num_steps: int = SEGMENT_STEPS) -> Path:
+  out_dir = Path(out_dir)
+  out_dir.mkdir(parents=True, exist_ok=True)
+  for i in range(num_segs):
+    generate_segment(seed + i, num_steps).to_csv(out_dir / f"{i:05d}.csv", index=False)
+  return out_dir
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--out_dir", type=str, required=True)
+  parser.add_argument("--num_segs", type=int, default=100)
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  write_segments(args.out_dir, args.num_segs, args.seed)
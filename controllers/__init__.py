@@ -10,3 +10,23 @@ class BaseController:
       The control signal to be applied to the vehicle.
     """
     raise NotImplementedError
+
+
+class BaseBatchController:
+  """
+  Optional vectorized counterpart of BaseController: one call per sim step for all B segments of a
+  BatchedTinyPhysicsSimulator, instead of a Python loop over per-segment controllers.
+  A controller module opts in by defining a BatchController(batch_size) class next to its Controller.
+  """
+  def update(self, target_lataccel, current_lataccel, state, future_plan):
+    """
+    Args:
+      target_lataccel: [B] target lateral accelerations.
+      current_lataccel: [B] current lateral accelerations.
+      state: State of [B] arrays (roll_lataccel, v_ego, a_ego).
+      future_plan: FuturePlan of [B, N] arrays for the next N frames, NaN past the end of a segment.
+    Returns:
+      [B] control signals. Rows whose segment has ended (or was pruned) are still passed in, with padded
+      inputs, and their outputs are ignored.
+    """
+    raise NotImplementedError
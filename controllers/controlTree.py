@@ -1,6 +1,7 @@
 from random import random, choice
-from tinyphysics import TinyPhysicsSimulator, TinyPhysicsModel
-from . import BaseController
+import numpy as np
+from tinyphysics import TinyPhysicsSimulator, get_model
+from . import BaseBatchController, BaseController
 from functools import partial
 from tqdm.contrib.concurrent import process_map
 from pathlib import Path
@@ -18,6 +19,8 @@ class Controller():
 
         self.errorIntegral = 0
         self.prevError = 0
+        # compiled form of the tree, rebuilt lazily after the tree changes
+        self.program = None
 
         # choose a random operator
         self.root = Node(choice(self.operators), depth=1)
@@ -44,6 +47,8 @@ class Controller():
     
     # update depth of entire tree
     def updateDepth(self): 
+        # crossover and mutation always end here, so this is where the compiled program goes stale
+        self.program = None
         return self.updateDepthRec(self.root, 1)
     
     def updateDepthRec(self, node, depth): 
@@ -68,8 +73,19 @@ class Controller():
             self.addRec(allNodes, node.right)
             self.addRec(allNodes, node.left)
 
+    # compiled closures can't be pickled, workers recompile on first use
+    def __getstate__(self): 
+        state = self.__dict__.copy()
+        state["program"] = None
+        return state
+
+    def compile(self): 
+        self.program = compileTree(self.root)
+        return self.program
+
     def rollout(self, modelPath, dataPath): 
-        model = TinyPhysicsModel(modelPath, debug=False)
+        self.compile()
+        model = get_model(modelPath)
         sim = TinyPhysicsSimulator(model, str(dataPath), self)
 
         return sim.rollout()
@@ -131,10 +147,12 @@ class Controller():
         errorDiff = error - self.prevError
         self.prevError = error
 
-        dicState = {"P": error, "I": self.errorIntegral, "D": errorDiff}
-        return self.evaluate(dicState)
+        if self.program is None: 
+            self.compile()
+        return self.program(error, self.errorIntegral, errorDiff)
 
     # here state is a dictionary
+    # reference interpreter, update() runs the equivalent compiled program
     def evaluate(self, state): 
         return self.evaluateRec(self.root, state)
     
@@ -167,3 +185,66 @@ class Node():
         self.me = me
         self.depth = depth
 
+
+# protected division: a zero denominator is replaced by 1
+def protectedDivide(a, b): 
+    return a / (b if b != 0 else 1)
+
+def protectedDivideArray(a, b): 
+    return a / np.where(b == 0, 1, b)
+
+OPERATOR_SOURCE = {"+": "({} + {})", "-": "({} - {})", "x": "({} * {})", "/": "pdiv({}, {})"}
+
+# python expression for a tree, operands in the same (right, left) order as evaluateRec
+def treeSource(node): 
+    if node.me in OPERATOR_SOURCE: 
+        return OPERATOR_SOURCE[node.me].format(treeSource(node.right), treeSource(node.left))
+    return str(node.me)
+
+# compile a tree once into a closure f(P, I, D)
+# vectorized=True takes numpy arrays of P/I/D, e.g. one entry per segment
+def compileTree(root, vectorized=False): 
+    namespace = {"pdiv": protectedDivideArray if vectorized else protectedDivide}
+    exec(f"def program(P, I, D):\n    return {treeSource(root)}\n", namespace)
+    return namespace["program"]
+
+# canonical serialization: postfix, with the operands of + and x in sorted order since swapping them
+# gives bit-identical results, so structurally equivalent trees get the same key
+def treeKey(node): 
+    if node.right is None: 
+        return str(node.me)
+    right, left = treeKey(node.right), treeKey(node.left)
+    if node.me in ("+", "x"): 
+        right, left = sorted([right, left])
+    return f"{right} {left} {node.me}"
+
+# vectorized controller for a batched simulator: row b is driven by trees[b] (random trees when only a size is given)
+# rows whose trees share a treeKey go through one vectorized program, every other row through its scalar program
+class BatchController(BaseBatchController): 
+    def __init__(self, batchSize=None, trees=None): 
+        if trees is None: 
+            trees = [Controller() for _ in range(batchSize)]
+        self.trees = trees
+        self.errorIntegral = np.zeros(len(trees))
+        self.prevError = np.zeros(len(trees))
+
+        groups = {}
+        for b, tree in enumerate(trees): 
+            groups.setdefault(treeKey(tree.root), []).append(b)
+        self.shared = [(np.array(rows), compileTree(trees[rows[0]].root, vectorized=True)) for rows in groups.values() if len(rows) > 1]
+        self.single = [(rows[0], compileTree(trees[rows[0]].root)) for rows in groups.values() if len(rows) == 1]
+
+    def update(self, target_lataccel, current_lataccel, state, future_plan):
+        error = (target_lataccel - current_lataccel)
+        self.errorIntegral += error
+        errorDiff = error - self.prevError
+        self.prevError = error
+
+        out = np.empty(len(error))
+        for rows, program in self.shared: 
+            out[rows] = program(error[rows], self.errorIntegral[rows], errorDiff[rows])
+        # python floats are much cheaper than numpy scalars for a single row, and give the same IEEE results
+        P, I, D = error.tolist(), self.errorIntegral.tolist(), errorDiff.tolist()
+        for b, program in self.single: 
+            out[b] = program(P[b], I[b], D[b])
+        return out
@@ -0,0 +1,63 @@
+from . import BaseBatchController, BaseController
+import numpy as np
+
+GAIN_NAMES = ['p', 'i', 'd', 'ff', 'ff_future', 'ff_roll']
+# pid's gains with the feed-forward terms off
+DEFAULT_GAINS = {'p': 0.3, 'i': 0.05, 'd': -0.1, 'ff': 0.0, 'ff_future': 0.0, 'ff_roll': 0.0}
+# future_plan frames averaged for the lookahead term
+HORIZON = 5
+
+
+class Controller(BaseController):
+  """
+  PID plus feed-forward on the target, on where the target is heading over the next `horizon` frames,
+  and on the road roll. tune.py searches these gains and writes controllers that subclass this one.
+  """
+  def __init__(self, horizon=HORIZON, **gains):
+    for name in GAIN_NAMES:
+      setattr(self, name, gains.get(name, DEFAULT_GAINS[name]))
+    self.horizon = horizon
+    self.error_integral = 0
+    self.prev_error = 0
+
+  def update(self, target_lataccel, current_lataccel, state, future_plan):
+    error = (target_lataccel - current_lataccel)
+    self.error_integral += error
+    error_diff = error - self.prev_error
+    self.prev_error = error
+    # summed in order so the result matches BatchController bit for bit
+    future, total = future_plan.lataccel[:self.horizon], 0.0
+    for value in future:
+      total += value
+    ahead = total / len(future) if len(future) else target_lataccel
+    return (self.p * error + self.i * self.error_integral + self.d * error_diff + self.ff * target_lataccel
+            + self.ff_future * (ahead - target_lataccel) + self.ff_roll * state.roll_lataccel)
+
+
+class BatchController(BaseBatchController):
+  """
+  Controller for B segments at once. Every gain can be a scalar or a [B] array, so one batch can roll out
+  B different gain sets; actions match per-segment Controllers with the same gains exactly.
+  """
+  def __init__(self, batch_size, horizon=HORIZON, **gains):
+    for name in GAIN_NAMES:
+      setattr(self, name, np.broadcast_to(np.asarray(gains.get(name, DEFAULT_GAINS[name]), dtype=np.float64), (batch_size,)))
+    self.horizon = horizon
+    self.error_integral = np.zeros(batch_size)
+    self.prev_error = np.zeros(batch_size)
+
+  def update(self, target_lataccel, current_lataccel, state, future_plan):
+    error = (target_lataccel - current_lataccel)
+    self.error_integral += error
+    error_diff = error - self.prev_error
+    self.prev_error = error
+    # future frames are NaN past the end of a segment: those are left out of the mean
+    future = future_plan.lataccel[:, :self.horizon]
+    valid = ~np.isnan(future)
+    total = np.zeros(len(error))
+    for k in range(future.shape[1]):
+      total += np.where(valid[:, k], future[:, k], 0.0)
+    count = valid.sum(axis=1)
+    ahead = np.where(count > 0, total / np.maximum(count, 1), target_lataccel)
+    return (self.p * error + self.i * self.error_integral + self.d * error_diff + self.ff * target_lataccel
+            + self.ff_future * (ahead - target_lataccel) + self.ff_roll * state.roll_lataccel)
@@ -1,4 +1,4 @@
-from . import BaseController
+from . import BaseBatchController, BaseController
 import numpy as np
 
 class Controller(BaseController):
@@ -18,3 +18,21 @@ class Controller(BaseController):
       error_diff = error - self.prev_error
       self.prev_error = error
       return self.p * error + self.i * self.error_integral + self.d * error_diff
+
+
+class BatchController(BaseBatchController):
+  """
+  Controller for B segments at once: same gains and arithmetic, so actions match per-segment Controllers exactly
+  """
+  def __init__(self, batch_size):
+    gains = Controller()
+    self.p, self.i, self.d = gains.p, gains.i, gains.d
+    self.error_integral = np.zeros(batch_size)
+    self.prev_error = np.zeros(batch_size)
+
+  def update(self, target_lataccel, current_lataccel, state, future_plan):
+    error = (target_lataccel - current_lataccel)
+    self.error_integral += error
+    error_diff = error - self.prev_error
+    self.prev_error = error
+    return self.p * error + self.i * self.error_integral + self.d * error_diff
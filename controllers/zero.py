@@ -1,4 +1,5 @@
-from . import BaseController
+from . import BaseBatchController, BaseController
+import numpy as np
 
 
 class Controller(BaseController):
@@ -7,3 +8,14 @@ class Controller(BaseController):
   """
   def update(self, target_lataccel, current_lataccel, state, future_plan):
     return 0.0
+
+
+class BatchController(BaseBatchController):
+  """
+  Zero actions for B segments at once
+  """
+  def __init__(self, batch_size):
+    self.batch_size = batch_size
+
+  def update(self, target_lataccel, current_lataccel, state, future_plan):
+    return np.zeros(self.batch_size)
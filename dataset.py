@@ -0,0 +1,194 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import urllib.error
+import urllib.request
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+from urllib.parse import unquote, urlparse
+from tqdm import tqdm
+
+from segment_cache import get_cache_path, write_cache
+
+CHUNK_SIZE = 1 << 20
+
+
+def open_stream(url: str, offset: int = 0, validator: Optional[str] = None) -> Tuple[BinaryIO, Optional[int], int, Optional[str]]:
+  """
+  Opens url for reading from byte offset.
+  Returns the stream, the total size if known, the offset it actually starts at (0 when a server ignores the Range
+  header, or when validator no longer matches the file), and the file's current validator: its ETag or Last-Modified,
+  if the server sends one. file:// URLs and plain paths (e.g. a local mirror) are read directly, with the same resume
+  support and their size and mtime as validator.
+  """
+  parsed = urlparse(url)
+  if parsed.scheme in ('', 'file'):
+    path = Path(unquote(parsed.path))
+    stat = path.stat()
+    current = f"{stat.st_size}-{stat.st_mtime_ns}"
+    offset = offset if validator is None or validator == current else 0
+    f = open(path, 'rb')
+    f.seek(offset)
+    return f, stat.st_size, offset, current
+
+  headers = {}
+  if offset:
+    headers['Range'] = f'bytes={offset}-'
+    if validator is not None:
+      # the server sends the whole file instead of the range if it changed since the partial download
+      headers['If-Range'] = validator
+  try:
+    resp = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+  except urllib.error.HTTPError as e:
+    if e.code == 416 and offset:
+      # range starts at the end of the file: the previous attempt already got everything
+      return BytesIO(), offset, offset, validator
+    raise
+  current = resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+  if resp.status == 206:
+    return resp, int(resp.headers['Content-Range'].rsplit('/', 1)[1]), offset, current
+  length = resp.headers.get('Content-Length')
+  return resp, int(length) if length is not None else None, 0, current
+
+
+def get_sha256(path: Union[str, Path]) -> str:
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while chunk := f.read(CHUNK_SIZE):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def download(url: str, dest: Union[str, Path], checksum: Optional[str] = None, retries: int = 5) -> Path:
+  """
+  Streams url to dest in CHUNK_SIZE pieces, so memory stays flat whatever the file size.
+  Bytes land in dest.part first: an interrupted download (in this call or an earlier run) resumes from there with a
+  Range request, and dest only appears once the size and, if given, the sha256 checksum match.
+  dest.part.json records the URL and validator the partial file came from; a dest.part from another URL, or from a
+  version of the file that has since changed, is started over instead of resumed.
+  """
+  dest = Path(dest)
+  part = Path(f"{dest}.part")
+  source_path = Path(f"{part}.json")
+  total = None
+  for attempt in range(retries + 1):
+    source = json.loads(source_path.read_text()) if source_path.exists() else {}
+    offset = part.stat().st_size if part.exists() and source.get('url') == url else 0
+    try:
+      stream, total, offset, validator = open_stream(url, offset, source.get('validator') if offset else None)
+      if offset and validator != source.get('validator'):
+        # the file changed, but the server sent the range anyway
+        stream.close()
+        stream, total, offset, validator = open_stream(url)
+      if offset == 0:
+        source_path.write_text(json.dumps({'url': url, 'validator': validator}))
+      with stream, open(part, 'r+b' if part.exists() else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        with tqdm(total=total, initial=offset, unit='B', unit_scale=True, desc=f"Downloading {dest.name}") as bar:
+          while chunk := stream.read(CHUNK_SIZE):
+            f.write(chunk)
+            bar.update(len(chunk))
+      break
+    except OSError as e:
+      if attempt == retries:
+        raise
+      print(f"Download interrupted ({e}), resuming")
+
+  size = part.stat().st_size
+  if total is not None and size != total:
+    raise IOError(f"downloaded {size} bytes of {url}, expected {total}")
+  if checksum is not None and get_sha256(part) != checksum.lower():
+    part.unlink()
+    source_path.unlink()
+    raise IOError(f"checksum mismatch for {url}")
+  part.replace(dest)
+  source_path.unlink()
+  return dest
+
+
+def is_metadata(member: str) -> bool:
+  # resource forks macOS adds when zipping, e.g. __MACOSX/data/._00000.csv
+  return member.startswith('__MACOSX/') or os.path.basename(member).startswith('._')
+
+
+def extract_members(members: List[str], zip_path: Union[str, Path], dest_dir: Union[str, Path], parse: bool = False) -> List[Optional[Dict]]:
+  # worker task: every worker opens the archive itself, so members decompress in parallel.
+  # zipfile checks each member's CRC as it is read. Only CSVs are parsed, other members (e.g. a README) get None
+  if parse:
+    from tinyphysics import read_csv
+
+  segments = []
+  with zipfile.ZipFile(zip_path) as z:
+    for member in members:
+      data = z.read(member)
+      with open(Path(dest_dir) / os.path.basename(member), 'wb') as f:
+        f.write(data)
+      segments.append(read_csv(BytesIO(data)) if parse and member.endswith('.csv') else None)
+  return segments
+
+
+def extract(zip_path: Union[str, Path], dest_dir: Union[str, Path], workers: Optional[int] = None, to_cache: bool = False) -> Path:
+  """
+  Extracts the archive's files (flattened, without macOS resource forks) into dest_dir with a pool of processes.
+  Members go to a temporary sibling directory that is renamed into place at the end, so dest_dir only exists
+  once extraction has finished. With to_cache, workers also parse each CSV as they extract it and the binary
+  segment cache for dest_dir is written from those, without reading the CSVs back.
+  """
+  dest_dir = Path(dest_dir)
+  if dest_dir.exists():
+    raise FileExistsError(f"{dest_dir} already exists")
+  tmp_dir = dest_dir.with_name(f"{dest_dir.name}.tmp")
+  shutil.rmtree(tmp_dir, ignore_errors=True)
+  tmp_dir.mkdir(parents=True)
+  with zipfile.ZipFile(zip_path) as z:
+    members = [member for member in z.namelist() if not member.endswith('/') and not is_metadata(member)]
+
+  workers = workers or os.cpu_count()
+  num_chunks = min(len(members), 4 * workers) or 1
+  chunks = [members[i::num_chunks] for i in range(num_chunks)]
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    extract_partial = partial(extract_members, zip_path=zip_path, dest_dir=tmp_dir, parse=to_cache)
+    results = list(tqdm(executor.map(extract_partial, chunks), total=len(chunks), desc="Extracting"))
+  tmp_dir.replace(dest_dir)
+
+  if to_cache:
+    parsed = {os.path.basename(member): segment for chunk, segments in zip(chunks, results) for member, segment in zip(chunk, segments)}
+    names = sorted(name for name in parsed if name.endswith('.csv'))
+    write_cache(get_cache_path(dest_dir), names, [parsed[name] for name in names], dest_dir)
+  return dest_dir
+
+
+def download_dataset(url: str, data_path: Union[str, Path], workers: Optional[int] = None, to_cache: bool = False,
+                     checksum: Optional[str] = None, keep_zip: bool = False) -> Path:
+  data_path = Path(data_path)
+  zip_path = data_path.with_name(f"{data_path.name}.zip")
+  if not zip_path.exists():
+    download(url, zip_path, checksum=checksum)
+  extract(zip_path, data_path, workers=workers, to_cache=to_cache)
+  if not keep_zip:
+    zip_path.unlink()
+  return data_path
+
+
+if __name__ == "__main__":
+  from tinyphysics import DATASET_PATH, DATASET_URL
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--url", type=str, default=DATASET_URL, help="http(s):// or file:// URL, or a local path to the zip")
+  parser.add_argument("--data_path", type=str, default=str(DATASET_PATH))
+  parser.add_argument("--workers", type=int, default=None, help="extraction processes")
+  parser.add_argument("--checksum", type=str, default=None, help="expected sha256 of the zip")
+  parser.add_argument("--to_cache", action='store_true', help="also write the binary segment cache while extracting")
+  parser.add_argument("--keep_zip", action='store_true')
+  args = parser.parse_args()
+
+  data_path = download_dataset(args.url, args.data_path, workers=args.workers, to_cache=args.to_cache, checksum=args.checksum, keep_zip=args.keep_zip)
+  print(f"Dataset saved to: '{data_path}'")
@@ -1,20 +1,18 @@
 import argparse
 import base64
+import importlib
 import numpy as np
-import pandas as pd
-import seaborn as sns
+import os
 
 
+from contextlib import nullcontext
 from functools import partial
 from io import BytesIO
-from matplotlib import pyplot as plt
 from pathlib import Path
-from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
 
-from tinyphysics import CONTROL_START_IDX, get_available_controllers, run_rollout
+from segment_cache import SharedSegmentStore
+from tinyphysics import CONTROL_START_IDX, BatchedTinyPhysicsSimulator, RolloutPool, TinyPhysicsSimulator, get_available_controllers, get_model, get_pyplot
 
-sns.set_theme()
 SAMPLE_ROLLOUTS = 5
 
 COLORS = {
@@ -31,6 +29,9 @@ def img2base64(fig):
 
 
 def create_report(test, baseline, sample_rollouts, costs, num_segs):
+  import pandas as pd
+
+  plt = get_pyplot()
   res = []
   res.append("""
   <html>
@@ -98,6 +99,16 @@ def create_report(test, baseline, sample_rollouts, costs, num_segs):
     print("Report saved to: './report.html'")
 
 
+def run_segment(task, model_path, future_plan_lists=True):
+  data_path, controller_types = task
+  # all controllers that still need this segment run as one batch: the segment is loaded once and every
+  # step is a single model call. Costs are the same as run_rollout's
+  controllers = [importlib.import_module(f'controllers.{controller_type}').Controller() for controller_type in controller_types]
+  sim = BatchedTinyPhysicsSimulator(get_model(model_path), [str(data_path)] * len(controllers), controllers, future_plan_lists=future_plan_lists)
+  costs = sim.rollout()
+  return [(cost, sim.current_lataccel_history[i, :sim.lengths[i]]) for i, cost in enumerate(costs)]
+
+
 if __name__ == "__main__":
   available_controllers = get_available_controllers()
   parser = argparse.ArgumentParser()
@@ -106,34 +117,71 @@ if __name__ == "__main__":
   parser.add_argument("--num_segs", type=int, default=100)
   parser.add_argument("--test_controller", default='pid', choices=available_controllers)
   parser.add_argument("--baseline_controller", default='pid', choices=available_controllers)
+  parser.add_argument("--workers", type=int, default=os.cpu_count(), help="rollout worker processes")
+  parser.add_argument("--results", type=str, default=None, help="SQLite results store to reuse rollouts from and record them in (off by default)")
+  parser.add_argument("--future_plan_arrays", action='store_true', help="pass future_plan fields as read-only ndarrays instead of lists")
+  parser.add_argument("--no_shared_segments", action='store_true', help="workers load segments themselves instead of from shared memory")
   args = parser.parse_args()
 
   data_path = Path(args.data_path)
   assert data_path.is_dir(), "data_path should be a directory"
 
-  costs = []
-  sample_rollouts = []
   files = sorted(data_path.iterdir())[:args.num_segs]
-  print("Running rollouts for visualizations...")
-  for d, data_file in enumerate(tqdm(files[:SAMPLE_ROLLOUTS], total=SAMPLE_ROLLOUTS)):
-    test_cost, test_target_lataccel, test_current_lataccel = run_rollout(data_file, args.test_controller, args.model_path, debug=False)
-    baseline_cost, baseline_target_lataccel, baseline_current_lataccel = run_rollout(data_file, args.baseline_controller, args.model_path, debug=False)
-    sample_rollouts.append({
-      'seg': data_file.stem,
-      'test_controller': args.test_controller,
-      'baseline_controller': args.baseline_controller,
-      'desired_lataccel': test_target_lataccel,
-      'test_controller_lataccel': test_current_lataccel,
-      'baseline_controller_lataccel': baseline_current_lataccel,
-    })
-
-    costs.append({'controller': 'test', **test_cost})
-    costs.append({'controller': 'baseline', **baseline_cost})
-
-  for controller_cat, controller_type in [('baseline', args.baseline_controller), ('test', args.test_controller)]:
-    print(f"Running batch rollouts => {controller_cat} controller: {controller_type}")
-    rollout_partial = partial(run_rollout, controller_type=controller_type, model_path=args.model_path, debug=False)
-    results = process_map(rollout_partial, files[SAMPLE_ROLLOUTS:], max_workers=16, chunksize=10)
-    costs += [{'controller': controller_cat, **result[0]} for result in results]
+  controllers = {'test': args.test_controller, 'baseline': args.baseline_controller}
+  controller_types = list(dict.fromkeys(controllers.values()))
+  # imported here so pool workers, which import this module for run_segment, skip sqlite
+  from results_store import ResultsStore, get_controller_hash, get_model_hash
+
+  model_hash = get_model_hash(args.model_path)
+  controller_hashes = {controller_type: get_controller_hash(controller_type) for controller_type in controller_types}
+
+  # with --results, rollouts already in that store are reused; otherwise an in-memory store stands in for it.
+  # Stored costs do not track edits to the segment files, so reusing them is opt-in
+  with ResultsStore(args.results or ':memory:') as store:
+    def has_history(controller_type, data_file):
+      return store.get_history(controller_type, controller_hashes[controller_type], model_hash, str(data_file)) is not None
+
+    # one task per segment with every controller it is missing; sample rollouts also need their lataccel histories
+    stored = {controller_type: store.get_many(controller_type, controller_hashes[controller_type], model_hash) for controller_type in controller_types}
+    tasks = []
+    for d, data_file in enumerate(files):
+      missing = [controller_type for controller_type in controller_types
+                 if str(data_file) not in stored[controller_type] or (d < SAMPLE_ROLLOUTS and not has_history(controller_type, data_file))]
+      if missing:
+        tasks.append((d, missing))
+
+    num_cached = len(files) * len(controller_types) - sum(len(missing) for _, missing in tasks)
+    print(f"Running rollouts => test: {args.test_controller}, baseline: {args.baseline_controller} ({num_cached} rollouts cached)")
+    results = []
+    if tasks:
+      # segments to roll out are parsed once here and read by the workers from shared memory
+      with SharedSegmentStore.create([files[d] for d, _ in tasks]) if not args.no_shared_segments else nullcontext() as segments, \
+           RolloutPool(args.model_path, max_workers=args.workers, segments=segments) as pool:
+        run_segment_partial = partial(run_segment, model_path=args.model_path, future_plan_lists=not args.future_plan_arrays)
+        results = pool.map(run_segment_partial, [(files[d], missing) for d, missing in tasks],
+                           chunksize=max(1, len(tasks) // (4 * args.workers)))
+    new_costs = {controller_type: [] for controller_type in controller_types}
+    for (d, missing), result in zip(tasks, results):
+      for controller_type, (cost, current_lataccel) in zip(missing, result):
+        new_costs[controller_type].append((str(files[d]), cost))
+        if d < SAMPLE_ROLLOUTS:
+          store.put_history(controller_type, controller_hashes[controller_type], model_hash, str(files[d]), current_lataccel)
+    for controller_type in controller_types:
+      store.put_many(controller_type, controller_hashes[controller_type], model_hash, new_costs[controller_type])
+      stored[controller_type].update({segment: {name: float(value) for name, value in cost.items()} for segment, cost in new_costs[controller_type]})
+
+    costs = []
+    sample_rollouts = []
+    for d, data_file in enumerate(files):
+      costs += [{'controller': controller_cat, **stored[controller_type][str(data_file)]} for controller_cat, controller_type in controllers.items()]
+      if d < SAMPLE_ROLLOUTS:
+        sample_rollouts.append({
+          'seg': data_file.stem,
+          'test_controller': args.test_controller,
+          'baseline_controller': args.baseline_controller,
+          'desired_lataccel': TinyPhysicsSimulator.get_data(str(data_file))['target_lataccel'],
+          'test_controller_lataccel': store.get_history(args.test_controller, controller_hashes[args.test_controller], model_hash, str(data_file)),
+          'baseline_controller_lataccel': store.get_history(args.baseline_controller, controller_hashes[args.baseline_controller], model_hash, str(data_file)),
+        })
 
   create_report(args.test_controller, args.baseline_controller, sample_rollouts, costs, len(files))
@@ -1,7 +1,18 @@
-from controllers.controlTree import Controller
-from random import random, choice, choices
+from controllers.controlTree import BatchController, Controller, treeKey
+from results_store import get_model_hash
+from segment_cache import SharedSegmentStore
+from tinyphysics import BatchedTinyPhysicsSimulator, RolloutPool, get_model
+from random import random, choice, choices, getstate, setstate
+from collections import OrderedDict
+from pathlib import Path
+import argparse
 import copy
+import gzip
+import json
+import numpy as np
+import pickle
 import sys
+import time
 from tqdm import tqdm
 
 # cross two trees over 
@@ -44,21 +55,271 @@ def mutate(tree):
     tree.updateDepth()
 
 
+# worker task: one segment and a batch of trees, stepped together so every sim step is one model call
+# the trees drive their rows through one vectorized BatchController, which keeps the per-row controller state
+# only total_cost is needed, so the steps after the cost window are skipped, and trees that are certain
+# to exceed costBudget stop early with their lower bound (returned as (cost, pruned) pairs)
+def evalSegment(task): 
+    modelPath, dataPath, trees, costBudget = task
+    sim = BatchedTinyPhysicsSimulator(get_model(modelPath), [dataPath] * len(trees), BatchController(trees=trees))
+    return [(c['total_cost'], c.get('pruned', False)) for c in sim.rollout(cost_budget=costBudget, stop_at_cost_end=True)]
+
+
+# rollout costs are deterministic (seeded from the segment path), so a (model, tree, segment) cost
+# never changes and can be reused by replicated offspring, repeated roulette picks and resumed runs
+class FitnessCache(): 
+    def __init__(self, maxSize=1000000, path=None): 
+        self.maxSize = maxSize
+        self.path = path
+        self.costs = OrderedDict()
+        if path is not None and Path(path).exists(): 
+            with open(path) as f: 
+                self.costs.update(json.load(f))
+
+    def key(self, modelHash, tree, segment): 
+        return f"{modelHash}|{segment}|{treeKey(tree.root)}"
+
+    def get(self, key): 
+        if key not in self.costs: 
+            return None
+        # least recently used entries are evicted first
+        self.costs.move_to_end(key)
+        return self.costs[key]
+
+    def put(self, key, cost): 
+        self.costs[key] = cost
+        self.costs.move_to_end(key)
+        while len(self.costs) > self.maxSize: 
+            self.costs.popitem(last=False)
+
+    def save(self): 
+        if self.path is not None: 
+            tmpPath = Path(f"{self.path}.tmp")
+            with open(tmpPath, "w") as f: 
+                json.dump(self.costs, f)
+            tmpPath.replace(self.path)
+
+    def __len__(self): 
+        return len(self.costs)
+
+
+# evaluates a whole population at once: all (tree x segment) pairs are scheduled on one persistent pool
+# whose workers keep the model loaded, so generation time scales with rollouts instead of pool startups
+# with sampleSegments, each generation is scored on its own numRollouts segments drawn from the first
+# sampleSegments files, seeded by the generation number so resumed runs draw the same subsets
+# with sharedSegments, every segment a generation can draw is loaded once into shared memory for all workers
+class PopulationEvaluator(): 
+    def __init__(self, modelPath, dataPath, numRollouts=10, workers=None, batchSize=32, cache=None, sampleSegments=None, seed=0, 
+                 costBudget=None, sharedSegments=True): 
+        self.modelPath = modelPath
+        # covers the simulator modules too, so persisted costs go stale under the same rules as ResultsStore's
+        self.modelHash = get_model_hash(modelPath)
+        self.allFiles = sorted(Path(dataPath).iterdir())[:sampleSegments]
+        self.files = self.allFiles[:numRollouts]
+        self.numRollouts = numRollouts
+        self.sampleSegments = sampleSegments
+        self.seed = seed
+        self.costBudget = costBudget
+        self.batchSize = batchSize
+        self.cache = cache if cache is not None else FitnessCache()
+        self.segments = SharedSegmentStore.create(self.allFiles if sampleSegments is not None else self.files) if sharedSegments else None
+        self.pool = RolloutPool(modelPath, max_workers=workers, segments=self.segments)
+        self.evaluations = 0
+        # costs served by the FitnessCache, and costs shared within an evaluation (copies of a tree, earlier racing rounds)
+        self.cacheHits = 0
+        self.reused = 0
+
+    def segmentsFor(self, generation): 
+        if self.sampleSegments is None or generation is None: 
+            return [str(f) for f in self.files]
+        rng = np.random.RandomState([self.seed, generation])
+        picks = rng.choice(len(self.allFiles), size=min(self.numRollouts, len(self.allFiles)), replace=False)
+        return [str(self.allFiles[i]) for i in sorted(picks)]
+
+    # total_cost of every tree on every segment, running only the rollouts that are not cached yet
+    # known carries costs between calls within one evaluation, including pruned lower bounds, which the cache
+    # does not keep but which stay valid while the budget is the same
+    def costs(self, population, segments, known=None): 
+        # roulette picks, replicated offspring and structurally identical trees share one key per segment
+        keys = {id(t): [self.cache.key(self.modelHash, t, seg) for seg in segments] for t in population}
+        known = known if known is not None else {}
+        tasks = []
+        hits = 0
+        for s, seg in enumerate(segments): 
+            missing = {}
+            for t in population: 
+                key = keys[id(t)][s]
+                if key in known or key in missing: 
+                    continue
+                cost = self.cache.get(key)
+                if cost is None: 
+                    missing[key] = t
+                else: 
+                    known[key] = cost
+                    hits += 1
+            misses = list(missing.items())
+            tasks += [(seg, misses[i:i + self.batchSize]) for i in range(0, len(misses), self.batchSize)]
+
+        results = self.pool.map(evalSegment, [(self.modelPath, seg, [t for _, t in batch], self.costBudget) for seg, batch in tasks], desc="Rollouts")
+        for (_, batch), batchCosts in zip(tasks, results): 
+            for (key, _), (cost, pruned) in zip(batch, batchCosts): 
+                known[key] = cost
+                # a pruned cost is only a lower bound, which a later run with a larger budget must not reuse
+                if not pruned: 
+                    self.cache.put(key, cost)
+        numRollouts = sum(len(batch) for _, batch in tasks)
+        self.evaluations += numRollouts
+        self.cacheHits += hits
+        self.reused += len(population) * len(segments) - numRollouts - hits
+        return {id(t): [known[key] for key in keys[id(t)]] for t in population}
+
+    def evaluate(self, population, generation=None): 
+        costs = self.costs(population, self.segmentsFor(generation))
+        # lower the cost, the higher the fitness (same as Controller.evalFitness)
+        for t in population: 
+            t.fitness = -1 * sum(costs[id(t)])/len(costs[id(t)])
+
+    def close(self): 
+        self.pool.close()
+        if self.segments is not None: 
+            self.segments.close()
+
+
+# successive halving: every tree is scored on the first minRollouts segments of the generation, then only
+# the best 1/eta of the distinct trees go on to eta times as many segments, until the survivors have all
+# numRollouts. A dropped tree's mean covers fewer segments than the survivors', so on its own it is not
+# comparable: it is raised to at least the worst mean of every tree that outlasted it, so the race order holds
+# in the fitness and roulette selection never favours a dropped tree over a survivor
+class RacingEvaluator(PopulationEvaluator): 
+    def __init__(self, modelPath, dataPath, numRollouts=10, minRollouts=2, eta=2, **kwargs): 
+        assert 1 <= minRollouts <= numRollouts and eta > 1
+        super().__init__(modelPath, dataPath, numRollouts=numRollouts, **kwargs)
+        self.minRollouts = minRollouts
+        self.eta = eta
+
+    def evaluate(self, population, generation=None): 
+        segments = self.segmentsFor(generation)
+        # race distinct trees only, so copies of a tree are never split between survivors and dropped
+        racers = {}
+        for t in population: 
+            racers.setdefault(treeKey(t.root), t)
+        alive = list(racers.values())
+        meanCost = {}
+        known = {}
+        # trees dropped in each round, in race order
+        dropped = []
+        numSegments = min(self.minRollouts, len(segments))
+        while True: 
+            # earlier rounds' segments are a prefix of this round's, so their costs (pruned ones too) are known
+            costs = self.costs(alive, segments[:numSegments], known)
+            for t in alive: 
+                meanCost[id(t)] = sum(costs[id(t)])/len(costs[id(t)])
+            if numSegments >= len(segments): 
+                break
+            ranked = sorted(alive, key=lambda t: meanCost[id(t)])
+            numAlive = max(1, int(np.ceil(len(alive) / self.eta)))
+            alive = ranked[:numAlive]
+            dropped.append(ranked[numAlive:])
+            numSegments = min(max(numSegments + 1, int(numSegments * self.eta)), len(segments))
+
+        # latest round first: every tree ends up no better than the worst tree that lasted longer
+        floor = max(meanCost[id(t)] for t in alive)
+        for roundDropped in reversed(dropped): 
+            for t in roundDropped: 
+                meanCost[id(t)] = max(meanCost[id(t)], floor)
+            floor = max([floor] + [meanCost[id(t)] for t in roundDropped])
+
+        for t in population: 
+            t.fitness = -1 * meanCost[id(racers[treeKey(t.root)])]
+
+
+# checkpoints are gzipped pickles, written to a temp file first so a crash mid-write keeps the last good one
+def saveCheckpoint(path, checkpoint): 
+    tmpPath = Path(f"{path}.tmp")
+    with gzip.open(tmpPath, "wb") as f: 
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmpPath.replace(path)
+
+def loadCheckpoint(path): 
+    with gzip.open(path, "rb") as f: 
+        return pickle.load(f)
+
+
+# one JSON line per generation, to follow fitness and throughput of long runs
+def logGeneration(path, record): 
+    if path is not None: 
+        with open(path, "a") as f: 
+            f.write(json.dumps(record) + "\n")
+
+
 # start with initial population of trees
 # select parents of population
 # crossover, mutate, or replicate to create offspring
 # repeat
 
-def naturalSelection(modelPath, dataPath, maxDepth, POP=100, GENERATIONS=1000):
-
-    parents = [] 
-    for _ in range(POP): 
-        tree = Controller(maxDepth=maxDepth)
-        tree.evalFitness(modelPath, dataPath)
-        parents.append(tree)
-
+def naturalSelection(modelPath, dataPath, maxDepth, POP=100, GENERATIONS=1000, workers=None, cachePath=None, 
+                     checkpointPath=None, checkpointEvery=1, telemetryPath=None, resume=False, 
+                     racing=False, minRollouts=2, eta=2, sampleSegments=None, costBudget=None, sharedSegments=True):
+    checkpoint = loadCheckpoint(checkpointPath) if resume else None
+    if checkpoint is not None and cachePath is None: 
+        # the checkpoint only records where its run kept the cache
+        cachePath = checkpoint.get("cachePath")
+    if checkpointPath is not None and cachePath is None: 
+        # checkpointed runs always persist the cache, next to the checkpoint unless told otherwise
+        cachePath = f"{checkpointPath}.cache.json"
+    cache = FitnessCache(path=cachePath)
+    if checkpoint is not None: 
+        # checkpoints from before cachePath embed the cache itself
+        for key, cost in checkpoint.get("cache", {}).items(): 
+            cache.put(key, cost)
+    if racing: 
+        evaluator = RacingEvaluator(modelPath, dataPath, minRollouts=minRollouts, eta=eta, workers=workers, cache=cache, 
+                                    sampleSegments=sampleSegments, costBudget=costBudget, sharedSegments=sharedSegments)
+    else: 
+        evaluator = PopulationEvaluator(modelPath, dataPath, workers=workers, cache=cache, sampleSegments=sampleSegments, costBudget=costBudget, 
+                                        sharedSegments=sharedSegments)
 
-    for i in tqdm(range(GENERATIONS)): 
+    def onGeneration(generation, parents, seconds, evaluations, cacheHits, reused): 
+        fit = [p.fitness for p in parents]
+        logGeneration(telemetryPath, {
+            "generation": generation, "avgFitness": sum(fit)/len(fit), "maxFitness": max(fit), "minFitness": min(fit),
+            "evaluations": evaluations, "cacheHits": cacheHits, "reused": reused, "seconds": seconds, "rolloutsPerSec": evaluations / seconds,
+        })
+        # written once per generation, before the checkpoint that refers to it
+        cache.save()
+        if checkpointPath is not None and (generation % checkpointEvery == 0 or generation == GENERATIONS): 
+            saveCheckpoint(checkpointPath, {
+                "config": {"modelPath": modelPath, "dataPath": dataPath, "maxDepth": maxDepth, "POP": POP, "GENERATIONS": GENERATIONS, 
+                           "racing": racing, "minRollouts": minRollouts, "eta": eta, "sampleSegments": sampleSegments, "costBudget": costBudget}, 
+                "generation": generation, "population": parents, "random": getstate(), "npRandom": np.random.get_state(), 
+                "cachePath": cachePath,
+            })
+
+    try: 
+        if checkpoint is None: 
+            return evolve(evaluator, maxDepth, POP, GENERATIONS, onGeneration=onGeneration)
+        setstate(checkpoint["random"])
+        np.random.set_state(checkpoint["npRandom"])
+        return evolve(evaluator, maxDepth, POP, GENERATIONS, parents=checkpoint["population"], 
+                      startGeneration=checkpoint["generation"], onGeneration=onGeneration)
+    finally: 
+        evaluator.close()
+
+
+# generation 0 is the random initial population, generation g the result of g rounds of selection
+def evolve(evaluator, maxDepth, POP, GENERATIONS, parents=None, startGeneration=0, onGeneration=None): 
+    def evaluateGeneration(generation, population): 
+        start, evaluations, cacheHits, reused = time.time(), evaluator.evaluations, evaluator.cacheHits, evaluator.reused
+        evaluator.evaluate(population, generation)
+        if onGeneration is not None: 
+            onGeneration(generation, population, time.time() - start, evaluator.evaluations - evaluations, evaluator.cacheHits - cacheHits, 
+                         evaluator.reused - reused)
+
+    if parents is None: 
+        parents = [Controller(maxDepth=maxDepth) for _ in range(POP)]
+        evaluateGeneration(0, parents)
+
+    for generation in tqdm(range(startGeneration + 1, GENERATIONS + 1), initial=startGeneration, total=GENERATIONS): 
         fit = [p.fitness for p in parents]
         totalFitness = sum(fit)
         print("Avg Fitness of Generation: ", totalFitness/len(parents))
@@ -108,10 +369,8 @@ def naturalSelection(modelPath, dataPath, maxDepth, POP=100, GENERATIONS=1000):
                             offspring.append(mateWith)
                             mated.add(i+1)
             
-        for o in offspring: 
-            o.evalFitness(modelPath, dataPath)
-
         parents = offspring[:POP]
+        evaluateGeneration(generation, parents)
 
     # in the end return the best control tree 
     bestFitness = -1 * sys.maxsize
@@ -125,17 +384,46 @@ def naturalSelection(modelPath, dataPath, maxDepth, POP=100, GENERATIONS=1000):
 
 
 if __name__ == "__main__":
-    bestTree, bestFitness = naturalSelection(modelPath="models/tinyphysics.onnx", dataPath="data", maxDepth=5, POP=100, GENERATIONS=30)
+    parser = argparse.ArgumentParser()
+    # run configuration: a resumed run keeps its checkpoint's, so these default to None to tell which were given
+    parser.add_argument("--model_path", type=str, default=None, help="default: models/tinyphysics.onnx")
+    parser.add_argument("--data_path", type=str, default=None, help="default: data")
+    parser.add_argument("--max_depth", type=int, default=None, help="default: 5")
+    parser.add_argument("--pop", type=int, default=None, help="default: 100")
+    parser.add_argument("--generations", type=int, default=None, help="default: 30; with --resume, extends or shortens the run")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache", type=str, default=None, help="JSON file to persist rollout costs in, written once per generation "
+                                                                 "(default with --checkpoint: next to the checkpoint)")
+    parser.add_argument("--checkpoint", type=str, default=None, help="gzipped pickle of population, RNG states and the --cache path")
+    parser.add_argument("--checkpoint_every", type=int, default=1)
+    parser.add_argument("--telemetry", type=str, default=None, help="JSONL file with per-generation stats")
+    parser.add_argument("--resume", action="store_true", help="continue the run saved in --checkpoint")
+    parser.add_argument("--racing", action="store_true", default=None, help="successive halving: only promising trees get all rollouts")
+    parser.add_argument("--min_rollouts", type=int, default=None, help="segments every tree is scored on when racing (default: 2)")
+    parser.add_argument("--eta", type=float, default=None, help="fraction 1/eta of trees kept per racing round (default: 2)")
+    parser.add_argument("--sample_segments", type=int, default=None, help="draw each generation's segments from the first N files")
+    parser.add_argument("--cost_budget", type=float, default=None, help="stop a rollout once its total_cost is certain to exceed this")
+    parser.add_argument("--no_shared_segments", action="store_true", help="workers load segments themselves instead of from shared memory")
+    args = parser.parse_args()
+
+    given = {"modelPath": args.model_path, "dataPath": args.data_path, "maxDepth": args.max_depth, "POP": args.pop, "GENERATIONS": args.generations, 
+             "racing": args.racing, "minRollouts": args.min_rollouts, "eta": args.eta, "sampleSegments": args.sample_segments, 
+             "costBudget": args.cost_budget}
+    given = {name: value for name, value in given.items() if value is not None}
+    if args.resume: 
+        # the run continues with the configuration it was started with; only its length can change
+        assert args.checkpoint is not None, "--resume needs --checkpoint"
+        config = loadCheckpoint(args.checkpoint)["config"]
+        conflicts = [name for name, value in given.items() if name != "GENERATIONS" and value != config.get(name)]
+        if conflicts: 
+            parser.error(f"--resume keeps the checkpoint's configuration, which differs in: {', '.join(conflicts)}")
+        config.update(given)
+    else: 
+        config = {"modelPath": "models/tinyphysics.onnx", "dataPath": "data", "maxDepth": 5, "POP": 100, "GENERATIONS": 30, 
+                  "racing": False, "minRollouts": 2, "eta": 2, "sampleSegments": None, "costBudget": None, **given}
+
+    bestTree, bestFitness = naturalSelection(**config, workers=args.workers, cachePath=args.cache, checkpointPath=args.checkpoint, 
+                                             checkpointEvery=args.checkpoint_every, telemetryPath=args.telemetry, resume=args.resume, 
+                                             sharedSegments=not args.no_shared_segments)
     bestTree.printTree()
     print("Fitness: ", bestFitness)
-
-
-
-
-
-
-
-
-
-
-
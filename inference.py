@@ -0,0 +1,272 @@
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+class InferenceBackend:
+  def run(self, input_data: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    Args:
+      input_data: {'states': [B, T, 4] float32, 'tokens': [B, T] int64}.
+    Returns:
+      [B, T, VOCAB_SIZE] float32 logits.
+    """
+    raise NotImplementedError
+
+
+class OrtBackend(InferenceBackend):
+  """
+  ONNX Runtime on CPU.
+  Args:
+    intra_op_num_threads, inter_op_num_threads: many single-threaded workers is usually best for
+      scalar rollouts, fewer workers with more intra-op threads for large batches.
+    graph_optimization_level: 'disable', 'basic', 'extended' or 'all' (ORT's default).
+    optimized_model_path: the optimized graph is saved here on first load and loaded from here
+      (without re-optimizing) afterwards. It is specific to the ORT version and machine that wrote it.
+    enable_mem_pattern: let ORT plan memory ahead for repeated runs with the same shapes.
+    io_binding: bind preallocated input/output buffers per batch shape. The returned logits are then a
+      buffer that is overwritten by the next run, so consume them before calling run again.
+  """
+  def __init__(self, model_path: str, intra_op_num_threads: int = 1, inter_op_num_threads: int = 1,
+               graph_optimization_level: str = 'all', optimized_model_path: str = None,
+               enable_mem_pattern: bool = True, io_binding: bool = False) -> None:
+    import onnxruntime as ort
+
+    levels = {
+      'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+      'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+      'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+      'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_num_threads
+    options.inter_op_num_threads = inter_op_num_threads
+    options.enable_mem_pattern = enable_mem_pattern
+    options.log_severity_level = 3
+    if optimized_model_path is not None and Path(optimized_model_path).exists():
+      model_path = optimized_model_path
+      options.graph_optimization_level = levels['disable']
+    else:
+      options.graph_optimization_level = levels[graph_optimization_level]
+      if optimized_model_path is not None:
+        options.optimized_model_filepath = str(optimized_model_path)
+
+    with open(model_path, "rb") as f:
+      self.ort_session = ort.InferenceSession(f.read(), options, ['CPUExecutionProvider'])
+    self.ort = ort
+    self.io_binding = io_binding
+    self.vocab_size = self.ort_session.get_outputs()[0].shape[-1]
+    self.bindings: Dict[Tuple[int, ...], Tuple[object, Dict[str, np.ndarray], np.ndarray]] = {}
+
+  def get_binding(self, shape: Tuple[int, ...]) -> Tuple[object, Dict[str, np.ndarray], np.ndarray]:
+    if shape not in self.bindings:
+      # OrtValues created from numpy arrays share their memory, so filling the arrays updates the inputs
+      inputs = {'states': np.zeros(shape, dtype=np.float32), 'tokens': np.zeros(shape[:2], dtype=np.int64)}
+      output = np.zeros((*shape[:2], self.vocab_size), dtype=np.float32)
+      binding = self.ort_session.io_binding()
+      for name, buffer in inputs.items():
+        binding.bind_ortvalue_input(name, self.ort.OrtValue.ortvalue_from_numpy(buffer))
+      binding.bind_ortvalue_output('output', self.ort.OrtValue.ortvalue_from_numpy(output))
+      self.bindings[shape] = (binding, inputs, output)
+    return self.bindings[shape]
+
+  def run(self, input_data: Dict[str, np.ndarray]) -> np.ndarray:
+    if not self.io_binding:
+      return self.ort_session.run(None, input_data)[0]
+    binding, inputs, output = self.get_binding(input_data['states'].shape)
+    for name, buffer in inputs.items():
+      np.copyto(buffer, input_data[name])
+    self.ort_session.run_with_iobinding(binding)
+    return output
+
+
+# Minimal ONNX reader: just enough of the protobuf wire format to load the graph and its weights
+# without the onnx or onnxruntime packages.
+ONNX_DTYPES = {1: np.float32, 6: np.int32, 7: np.int64, 9: np.bool_, 11: np.float64}
+
+
+def read_varint(buf: memoryview, pos: int) -> Tuple[int, int]:
+  result, shift = 0, 0
+  while True:
+    b = buf[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return result, pos
+    shift += 7
+
+
+def to_int64(value: int) -> int:
+  return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def read_fields(buf: memoryview) -> List[Tuple[int, int, object]]:
+  fields, pos = [], 0
+  while pos < len(buf):
+    key, pos = read_varint(buf, pos)
+    number, wire_type = key >> 3, key & 7
+    if wire_type == 0:
+      value, pos = read_varint(buf, pos)
+    elif wire_type == 1:
+      value, pos = buf[pos:pos + 8], pos + 8
+    elif wire_type == 2:
+      size, pos = read_varint(buf, pos)
+      value, pos = buf[pos:pos + size], pos + size
+    elif wire_type == 5:
+      value, pos = buf[pos:pos + 4], pos + 4
+    else:
+      raise ValueError(f"unsupported protobuf wire type {wire_type}")
+    fields.append((number, wire_type, value))
+  return fields
+
+
+def read_ints(wire_type: int, value) -> List[int]:
+  if wire_type == 0:
+    return [to_int64(value)]
+  ints, pos = [], 0
+  while pos < len(value):
+    v, pos = read_varint(value, pos)
+    ints.append(to_int64(v))
+  return ints
+
+
+def read_tensor(buf: memoryview) -> Tuple[str, np.ndarray]:
+  name, dims, dtype, raw, floats, ints = '', [], np.float32, None, [], []
+  for number, wire_type, value in read_fields(buf):
+    if number == 1:
+      dims += read_ints(wire_type, value)
+    elif number == 2:
+      dtype = ONNX_DTYPES[value]
+    elif number == 4:
+      floats += np.frombuffer(value, dtype='<f4').tolist() if wire_type == 2 else [np.frombuffer(value, dtype='<f4')[0]]
+    elif number in (5, 7):
+      ints += read_ints(wire_type, value)
+    elif number == 8:
+      name = bytes(value).decode()
+    elif number == 9:
+      raw = bytes(value)
+  if raw is not None:
+    array = np.frombuffer(raw, dtype=np.dtype(dtype).newbyteorder('<')).astype(dtype)
+  else:
+    array = np.array(floats if floats else ints, dtype=dtype)
+  return name, array.reshape(dims)
+
+
+def read_attribute(buf: memoryview) -> Tuple[str, object]:
+  name, values = '', {}
+  for number, wire_type, value in read_fields(buf):
+    if number == 1:
+      name = bytes(value).decode()
+    elif number == 2:
+      values['f'] = float(np.frombuffer(value, dtype='<f4')[0])
+    elif number == 3:
+      values['i'] = to_int64(value)
+    elif number == 4:
+      values['s'] = bytes(value).decode()
+    elif number == 5:
+      values['t'] = read_tensor(value)[1]
+    elif number == 8:
+      values.setdefault('ints', []).extend(read_ints(wire_type, value))
+  return name, next(iter(values.values())) if values else None
+
+
+def read_node(buf: memoryview) -> Tuple[str, List[str], List[str], Dict[str, object]]:
+  op_type, inputs, outputs, attributes = '', [], [], {}
+  for number, _, value in read_fields(buf):
+    if number == 1:
+      inputs.append(bytes(value).decode())
+    elif number == 2:
+      outputs.append(bytes(value).decode())
+    elif number == 4:
+      op_type = bytes(value).decode()
+    elif number == 5:
+      attr_name, attr_value = read_attribute(value)
+      attributes[attr_name] = attr_value
+  return op_type, inputs, outputs, attributes
+
+
+def read_onnx(model_path: str) -> Tuple[List[Tuple[str, List[str], List[str], Dict[str, object]]], Dict[str, np.ndarray], List[str]]:
+  with open(model_path, "rb") as f:
+    model = memoryview(f.read())
+  graph = next(value for number, _, value in read_fields(model) if number == 7)
+  nodes, initializers, outputs = [], {}, []
+  for number, _, value in read_fields(graph):
+    if number == 1:
+      nodes.append(read_node(value))
+    elif number == 5:
+      name, array = read_tensor(value)
+      initializers[name] = array
+    elif number == 12:
+      outputs.append(next(bytes(v).decode() for n, _, v in read_fields(value) if n == 1))
+  return nodes, initializers, outputs
+
+
+def reshape(data, shape, allowzero=0):
+  shape = [data.shape[i] if (d == 0 and not allowzero) else d for i, d in enumerate(shape.tolist())]
+  return data.reshape(shape)
+
+
+def divide(a, b):
+  return a // b if np.issubdtype(a.dtype, np.integer) else a / b
+
+
+def softmax(x, axis=-1):
+  e_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
+  return e_x / np.sum(e_x, axis=axis, keepdims=True)
+
+
+ONNX_OPS = {
+  'Identity': lambda x: x,
+  'Constant': lambda value: value,
+  'Shape': lambda x: np.array(x.shape, dtype=np.int64),
+  'Gather': lambda data, indices, axis=0: np.take(data, indices, axis=axis),
+  'Cast': lambda x, to: x.astype(ONNX_DTYPES[to]),
+  'Range': lambda start, limit, delta: np.arange(start, limit, delta, dtype=start.dtype),
+  'Unsqueeze': lambda data, axes: np.expand_dims(data, tuple(axes.tolist())),
+  'Concat': lambda *xs, axis: np.concatenate(xs, axis=axis),
+  'Reshape': reshape,
+  'Transpose': lambda x, perm: np.transpose(x, perm),
+  'Split': lambda x, split, axis=0: np.split(x, np.cumsum(split)[:-1], axis=axis),
+  'MatMul': np.matmul,
+  'Add': np.add,
+  'Sub': np.subtract,
+  'Mul': np.multiply,
+  'Div': divide,
+  'Pow': lambda x, y: np.power(x, y).astype(x.dtype),
+  'Sqrt': np.sqrt,
+  'Tanh': np.tanh,
+  'Not': np.logical_not,
+  'Where': np.where,
+  'ReduceMean': lambda x, axes, keepdims=1: np.mean(x, axis=tuple(axes), keepdims=bool(keepdims)),
+  'Softmax': softmax,
+}
+
+
+class NumpyBackend(InferenceBackend):
+  """
+  Pure-NumPy reference interpreter for the tinyphysics graph, for environments without onnxruntime.
+  Logits agree with ORT to float32 rounding, so sampled tokens (and costs) can differ on rare ties.
+  """
+  def __init__(self, model_path: str) -> None:
+    self.nodes, self.initializers, self.outputs = read_onnx(model_path)
+    for op_type, _, _, _ in self.nodes:
+      if op_type not in ONNX_OPS:
+        raise NotImplementedError(f"NumpyBackend does not implement ONNX op {op_type}")
+
+  def run(self, input_data: Dict[str, np.ndarray]) -> np.ndarray:
+    values = {**self.initializers, **input_data}
+    for op_type, inputs, outputs, attributes in self.nodes:
+      result = ONNX_OPS[op_type](*(values[name] for name in inputs), **attributes)
+      if len(outputs) == 1:
+        result = [result]
+      for name, value in zip(outputs, result):
+        values[name] = np.asarray(value)
+    return values[self.outputs[0]]
+
+
+BACKENDS = {'ort': OrtBackend, 'numpy': NumpyBackend}
+
+
+def get_backend(backend: str, model_path: str, **backend_options) -> InferenceBackend:
+  return BACKENDS[backend](model_path, **backend_options)
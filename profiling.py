@@ -0,0 +1,95 @@
+import numpy as np
+import os
+
+from collections import defaultdict
+from time import perf_counter
+from typing import Dict, List
+
+PHASES = ['data', 'controller', 'inputs', 'inference', 'sampling', 'history', 'other']
+
+
+class StepProfiler:
+  """
+  Per-phase wall-clock timers for a rollout.
+  attach() wraps the simulator's step methods and its model's pieces on the instances only, so a
+  simulator without a profiler runs the untouched code path with zero overhead.
+  Times are exclusive: a phase does not include the phases nested inside it.
+  """
+  def __init__(self) -> None:
+    self.totals = dict.fromkeys(PHASES, 0.0)
+    self.stack: List[float] = []
+    self.patched = []
+    self.steps = 0
+
+  def wrap(self, phase: str, fn):
+    def timed(*args, **kwargs):
+      self.stack.append(0.0)
+      start = perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        elapsed = perf_counter() - start
+        self.totals[phase] += elapsed - self.stack.pop()
+        if self.stack:
+          self.stack[-1] += elapsed
+    return timed
+
+  def patch(self, obj, name: str, phase: str) -> None:
+    if hasattr(obj, name):
+      # remember instance-level attributes so detach can tell restoring apart from deleting the wrapper
+      self.patched.append((obj, name, vars(obj).get(name)))
+      setattr(obj, name, self.wrap(phase, getattr(obj, name)))
+
+  def attach(self, sim) -> 'StepProfiler':
+    model = sim.sim_model
+    self.patch(sim, 'step', 'other')
+    self.patch(sim, 'control_step', 'history')
+    self.patch(sim, 'sim_step', 'history')
+    self.patch(sim, 'get_futureplan', 'data')
+    self.patch(sim, 'get_state_target_futureplan', 'data')
+    for controller in getattr(sim, 'controllers', [getattr(sim, 'controller', None)]):
+      self.patch(controller, 'update', 'controller')
+    self.patch(model.tokenizer, 'encode', 'inputs')
+    self.patch(model.backend, 'run', 'inference')
+    self.patch(model, 'sample', 'sampling')
+    self.patch(model.tokenizer, 'decode', 'sampling')
+    self.steps_at_attach = sim.step_idx
+    self.sim = sim
+    return self
+
+  def detach(self) -> None:
+    self.steps += self.sim.step_idx - self.steps_at_attach
+    for obj, name, original in reversed(self.patched):
+      if original is not None:
+        setattr(obj, name, original)
+      else:
+        delattr(obj, name)
+    self.patched = []
+
+  def record(self) -> Dict[str, object]:
+    return {'pid': os.getpid(), 'steps': self.steps, 'phases': dict(self.totals)}
+
+
+def profile_report(records: List[Dict[str, object]]) -> str:
+  """
+  Aggregates per-rollout profiler records into per-phase percentiles and per-worker totals.
+  """
+  phases = {phase: np.array([r['phases'][phase] for r in records]) for phase in PHASES}
+  rollout_times = sum(phases.values())
+  total = rollout_times.sum()
+  steps = sum(r['steps'] for r in records)
+  lines = [f"Profile: {len(records)} rollouts, {steps} steps, {total:.2f}s in instrumented code",
+           f"{'phase':<12}{'share':>8}{'us/step':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"]
+  for phase, times in phases.items():
+    p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1e3
+    lines.append(f"{phase:<12}{times.sum() / total:>8.1%}{times.sum() / steps * 1e6:>10.1f}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}")
+  p50, p90, p99 = np.percentile(rollout_times, [50, 90, 99]) * 1e3
+  lines.append(f"{'rollout':<12}{'':>8}{total / steps * 1e6:>10.1f}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}")
+
+  workers = defaultdict(list)
+  for record, seconds in zip(records, rollout_times):
+    workers[record['pid']].append(seconds)
+  lines.append(f"{'worker':<12}{'rollouts':>10}{'total s':>10}{'mean ms':>10}")
+  for pid, times in sorted(workers.items()):
+    lines.append(f"{pid:<12}{len(times):>10}{sum(times):>10.2f}{np.mean(times) * 1e3:>10.2f}")
+  return "\n".join(lines)
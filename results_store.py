@@ -0,0 +1,230 @@
+import argparse
+import os
+import sqlite3
+import time
+import numpy as np
+
+from functools import partial
+from hashlib import md5
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+COST_NAMES = ['lataccel_cost', 'jerk_cost', 'total_cost']
+# modules a rollout's costs depend on besides the model and the controller
+SIMULATOR_MODULES = ['tinyphysics.py', 'inference.py', 'segment_cache.py']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+  controller TEXT NOT NULL,
+  controller_hash TEXT NOT NULL,
+  model_hash TEXT NOT NULL,
+  segment TEXT NOT NULL,
+  lataccel_cost REAL NOT NULL,
+  jerk_cost REAL NOT NULL,
+  total_cost REAL NOT NULL,
+  created REAL NOT NULL,
+  PRIMARY KEY (controller, controller_hash, model_hash, segment)
+);
+CREATE TABLE IF NOT EXISTS histories (
+  controller TEXT NOT NULL,
+  controller_hash TEXT NOT NULL,
+  model_hash TEXT NOT NULL,
+  segment TEXT NOT NULL,
+  current_lataccel BLOB NOT NULL,
+  PRIMARY KEY (controller, controller_hash, model_hash, segment)
+);
+"""
+
+
+def get_controller_hash(controller_type: str) -> str:
+  from tinyphysics import get_file_hash
+
+  # only the controller's own module is hashed, not the modules it imports
+  return get_file_hash(Path('controllers') / f"{controller_type}.py")
+
+
+def get_model_hash(model_path: str, backend: str = 'ort', sampling: str = 'exact', **backend_options) -> str:
+  from tinyphysics import get_file_hash
+
+  # the simulator's own modules are part of the model hash, so a change to them invalidates stored costs
+  root = Path(__file__).parent
+  parts = [get_file_hash(path) for path in [model_path, *(root / name for name in SIMULATOR_MODULES)]]
+  # other backends and fast sampling can pick different tokens, so their costs are kept apart from the default's.
+  # backend_options (threads, ...) do not change costs
+  if (backend, sampling) != ('ort', 'exact'):
+    parts.append(f"{backend}|{sampling}")
+  return md5("".join(parts).encode()).hexdigest()
+
+
+class ResultsStore:
+  """
+  Per-segment rollout costs in SQLite, keyed by (controller, controller hash, model hash, segment), plus optional
+  current_lataccel histories under the same key (eval.py keeps them for its sample plots).
+  Rollouts are seeded from the segment path, so the segment is stored as the path the rollout was run with,
+  and a stored cost stays valid until the controller's file, the model or the simulator modules change.
+  The model hash (get_model_hash) also tells apart costs from a non-default backend or sampling mode.
+  Segment files are not hashed: a store is only valid for the dataset it was filled from.
+  """
+  def __init__(self, path: Union[str, Path]) -> None:
+    self.path = Path(path)
+    self.db = sqlite3.connect(self.path)
+    primary_key = [row[1] for row in sorted(self.db.execute("PRAGMA table_info(results)"), key=lambda row: row[5]) if row[5]]
+    with self.db:
+      if primary_key and 'controller' not in primary_key:
+        # stores from before the controller was part of the key
+        self.db.execute("ALTER TABLE results RENAME TO results_old")
+        self.db.executescript(SCHEMA)
+        self.db.execute("INSERT INTO results SELECT * FROM results_old")
+        self.db.execute("DROP TABLE results_old")
+      self.db.executescript(SCHEMA)
+
+  def put(self, controller: str, controller_hash: str, model_hash: str, segment: str, cost: Dict[str, float]) -> None:
+    self.put_many(controller, controller_hash, model_hash, [(segment, cost)])
+
+  def put_many(self, controller: str, controller_hash: str, model_hash: str, results: Iterable) -> None:
+    rows = [(controller, controller_hash, model_hash, str(segment), *(float(cost[name]) for name in COST_NAMES), time.time())
+            for segment, cost in results]
+    with self.db:
+      self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+  def get(self, controller: str, controller_hash: str, model_hash: str, segment: str) -> Optional[Dict[str, float]]:
+    row = self.db.execute(f"SELECT {', '.join(COST_NAMES)} FROM results WHERE controller = ? AND controller_hash = ? AND model_hash = ? AND segment = ?",
+                          (controller, controller_hash, model_hash, str(segment))).fetchone()
+    return None if row is None else dict(zip(COST_NAMES, row))
+
+  def get_many(self, controller: str, controller_hash: str, model_hash: str) -> Dict[str, Dict[str, float]]:
+    rows = self.db.execute(f"SELECT segment, {', '.join(COST_NAMES)} FROM results WHERE controller = ? AND controller_hash = ? AND model_hash = ?",
+                           (controller, controller_hash, model_hash))
+    return {segment: dict(zip(COST_NAMES, costs)) for segment, *costs in rows}
+
+  def missing(self, controller: str, controller_hash: str, model_hash: str, segments: Iterable) -> List:
+    stored = self.get_many(controller, controller_hash, model_hash)
+    return [segment for segment in segments if str(segment) not in stored]
+
+  def put_history(self, controller: str, controller_hash: str, model_hash: str, segment: str, current_lataccel: np.ndarray) -> None:
+    with self.db:
+      self.db.execute("INSERT OR REPLACE INTO histories VALUES (?, ?, ?, ?, ?)",
+                      (controller, controller_hash, model_hash, str(segment), np.asarray(current_lataccel, dtype=np.float64).tobytes()))
+
+  def get_history(self, controller: str, controller_hash: str, model_hash: str, segment: str) -> Optional[np.ndarray]:
+    row = self.db.execute("SELECT current_lataccel FROM histories WHERE controller = ? AND controller_hash = ? AND model_hash = ? AND segment = ?",
+                          (controller, controller_hash, model_hash, str(segment))).fetchone()
+    return None if row is None else np.frombuffer(row[0], dtype=np.float64)
+
+  def aggregate(self, model_hash: Optional[str] = None) -> List[Dict[str, object]]:
+    """
+    Mean costs and segment counts per (controller, controller hash, model hash).
+    """
+    where, params = ("WHERE model_hash = ?", (model_hash,)) if model_hash is not None else ("", ())
+    query = f"""
+      SELECT controller, controller_hash, model_hash, COUNT(*), {', '.join(f'AVG({name})' for name in COST_NAMES)}
+      FROM results {where} GROUP BY controller, controller_hash, model_hash ORDER BY controller, MAX(created)
+    """
+    return [dict(zip(['controller', 'controller_hash', 'model_hash', 'segments', *COST_NAMES], row))
+            for row in self.db.execute(query, params)]
+
+  def diff(self, controller_a: str, controller_hash_a: str, controller_b: str, controller_hash_b: str, model_hash: str) -> List[Dict[str, object]]:
+    """
+    Per-segment costs of two controllers on the segments both have results for, with b - a deltas.
+    """
+    query = f"""
+      SELECT a.segment, {', '.join(f'a.{name}, b.{name}' for name in COST_NAMES)}
+      FROM results a JOIN results b ON a.segment = b.segment AND a.model_hash = b.model_hash
+      WHERE a.controller = ? AND a.controller_hash = ? AND b.controller = ? AND b.controller_hash = ? AND a.model_hash = ?
+      ORDER BY a.segment
+    """
+    diffs = []
+    for segment, *costs in self.db.execute(query, (controller_a, controller_hash_a, controller_b, controller_hash_b, model_hash)):
+      diff = {'segment': segment}
+      for name, a, b in zip(COST_NAMES, costs[0::2], costs[1::2]):
+        diff.update({f'{name}_a': a, f'{name}_b': b, f'{name}_delta': b - a})
+      diffs.append(diff)
+    return diffs
+
+  def count(self, controller: str, controller_hash: str, model_hash: str) -> int:
+    return self.db.execute("SELECT COUNT(*) FROM results WHERE controller = ? AND controller_hash = ? AND model_hash = ?",
+                           (controller, controller_hash, model_hash)).fetchone()[0]
+
+  def latest_controller_hash(self, controller: str, model_hash: str) -> Optional[str]:
+    row = self.db.execute("SELECT controller_hash FROM results WHERE controller = ? AND model_hash = ? ORDER BY created DESC LIMIT 1",
+                          (controller, model_hash)).fetchone()
+    return None if row is None else row[0]
+
+  def close(self) -> None:
+    self.db.close()
+
+  def __enter__(self) -> 'ResultsStore':
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+
+def fill(store: ResultsStore, controller_type: str, model_path: str, files: List, workers: int = None) -> int:
+  """
+  Runs controller_type on the segments in files that the store has no result for yet, and records them.
+  """
+  from tinyphysics import RolloutPool, run_rollout
+
+  controller_hash, model_hash = get_controller_hash(controller_type), get_model_hash(model_path)
+  missing = store.missing(controller_type, controller_hash, model_hash, [str(f) for f in files])
+  if missing:
+    with RolloutPool(model_path, max_workers=workers) as pool:
+      run_rollout_partial = partial(run_rollout, controller_type=controller_type, model_path=model_path)
+      results = pool.map(run_rollout_partial, missing, chunksize=max(1, len(missing) // (4 * (workers or os.cpu_count()))), desc=controller_type)
+    store.put_many(controller_type, controller_hash, model_hash, [(segment, result[0]) for segment, result in zip(missing, results)])
+  return len(missing)
+
+
+def format_rows(rows: List[Dict[str, object]], columns: List[str]) -> str:
+  def fmt(value):
+    return f"{value:.4f}" if isinstance(value, float) else str(value)
+  widths = [max([len(column)] + [len(fmt(row[column])) for row in rows]) for column in columns]
+  lines = ["  ".join(column.ljust(width) for column, width in zip(columns, widths))]
+  lines += ["  ".join(fmt(row[column]).ljust(width) for column, width in zip(columns, widths)) for row in rows]
+  return "\n".join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--results", type=str, default="results.sqlite")
+  parser.add_argument("--model_path", type=str, default="./models/tinyphysics.onnx")
+  commands = parser.add_subparsers(dest="command", required=True)
+  commands.add_parser("aggregate", help="mean costs per controller version")
+  diff_parser = commands.add_parser("diff", help="per-segment comparison of two controllers on their common segments")
+  diff_parser.add_argument("controller_a")
+  diff_parser.add_argument("controller_b")
+  diff_parser.add_argument("--segments", action='store_true', help="print every segment, not only the summary")
+  fill_parser = commands.add_parser("fill", help="roll out a controller on the segments it has no results for")
+  fill_parser.add_argument("controller")
+  fill_parser.add_argument("--data_path", type=str, required=True)
+  fill_parser.add_argument("--num_segs", type=int, default=100)
+  fill_parser.add_argument("--workers", type=int, default=None)
+  args = parser.parse_args()
+
+  model_hash = get_model_hash(args.model_path)
+  with ResultsStore(args.results) as store:
+    if args.command == "aggregate":
+      print(format_rows(store.aggregate(model_hash), ['controller', 'controller_hash', 'segments', *COST_NAMES]))
+    elif args.command == "diff":
+      # controllers are compared in their current version if it has results, else their latest recorded one
+      hashes = []
+      for controller in [args.controller_a, args.controller_b]:
+        controller_hash = get_controller_hash(controller) if (Path('controllers') / f"{controller}.py").exists() else None
+        if controller_hash is None or not store.count(controller, controller_hash, model_hash):
+          controller_hash = store.latest_controller_hash(controller, model_hash)
+        hashes.append(controller_hash)
+      diffs = store.diff(args.controller_a, hashes[0], args.controller_b, hashes[1], model_hash)
+      if args.segments:
+        print(format_rows(diffs, ['segment', 'total_cost_a', 'total_cost_b', 'total_cost_delta']))
+      if diffs:
+        for name in COST_NAMES:
+          deltas = [d[f'{name}_delta'] for d in diffs]
+          better = sum(delta < 0 for delta in deltas)
+          print(f"{name:<14} mean delta (b - a): {sum(deltas) / len(deltas):>10.4f}   b better on {better}/{len(deltas)} segments")
+      else:
+        print("No segments with results for both controllers")
+    elif args.command == "fill":
+      files = sorted(Path(args.data_path).iterdir())[:args.num_segs]
+      num_run = fill(store, args.controller, args.model_path, files, workers=args.workers)
+      print(f"Ran {num_run} rollouts, {len(files) - num_run} segments already stored")
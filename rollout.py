@@ -0,0 +1,83 @@
+"""
+Headless rollouts: the tinyphysics.py CLI without plotting, pandas or the dataset download, for batch runs,
+servers and scripts. Prints the average costs, or one JSON object per segment with --json.
+
+  python rollout.py --model_path ./models/tinyphysics.onnx --data_path ./data --num_segs 100 --controller pid
+"""
+import argparse
+import json
+import os
+import sys
+import numpy as np
+
+from functools import partial
+from pathlib import Path
+
+from profiling import profile_report
+from tinyphysics import RolloutPool, get_available_controllers, run_monte_carlo_rollout, run_rollouts
+
+COST_NAMES = ['lataccel_cost', 'jerk_cost', 'total_cost']
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--model_path", type=str, required=True)
+  parser.add_argument("--data_path", type=str, required=True, help="a segment file or a directory of segments")
+  parser.add_argument("--num_segs", type=int, default=100)
+  parser.add_argument("--batch_size", type=int, default=1, help="segments stepped together per model call")
+  parser.add_argument("--workers", type=int, default=os.cpu_count(), help="rollout worker processes")
+  parser.add_argument("--backend", default='ort', choices=['ort', 'numpy'])
+  parser.add_argument("--threads", type=int, default=1, help="intra-op threads per ORT session")
+  parser.add_argument("--profile", action='store_true', help="time each phase of the sim step and print a report")
+  parser.add_argument("--controller", default='pid', choices=get_available_controllers())
+  parser.add_argument("--results", type=str, default=None, help="SQLite results store to record per-segment costs in")
+  parser.add_argument("--json", action='store_true', help="print per-segment costs as JSON lines")
+  parser.add_argument("--future_plan_arrays", action='store_true', help="pass future_plan fields as read-only ndarrays instead of lists")
+  parser.add_argument("--replicas", type=int, default=1, help="stochastic rollouts per segment; > 1 reports cost mean/std/quantiles")
+  args = parser.parse_args()
+  if args.profile and (args.batch_size > 1 or args.replicas > 1):
+    parser.error("--profile is only supported with --batch_size 1 and --replicas 1")
+
+  model_options = {'backend': args.backend}
+  if args.backend == 'ort':
+    model_options['intra_op_num_threads'] = args.threads
+
+  data_path = Path(args.data_path)
+  files = [data_path] if data_path.is_file() else sorted(data_path.iterdir())[:args.num_segs]
+  workers = min(args.workers, len(files))
+  if args.replicas > 1:
+    # Monte Carlo mode: each task runs all replicas of one segment as one batch
+    with RolloutPool(args.model_path, max_workers=workers, **model_options) as pool:
+      run_partial = partial(run_monte_carlo_rollout, controller_type=args.controller, model_path=args.model_path, replicas=args.replicas,
+                            future_plan_lists=not args.future_plan_arrays)
+      summaries = pool.map(run_partial, files, desc="Segments")
+    for summary in summaries:
+      total = summary['total_cost']
+      if args.json:
+        print(json.dumps({'segment': summary['segment'], 'controller': args.controller, 'replicas': args.replicas,
+                          **{name: summary[name] for name in COST_NAMES}}))
+      else:
+        print(f"{summary['segment']}: total_cost mean {total['mean']:>8.2f} std {total['std']:>7.2f} "
+              f"p5 {total['p5']:>8.2f} p50 {total['p50']:>8.2f} p95 {total['p95']:>8.2f}")
+    if not args.json:
+      print(f"Average total_cost: {np.mean([s['total_cost']['mean'] for s in summaries]):>6.4}, "
+            f"average per-segment std: {np.mean([s['total_cost']['std'] for s in summaries]):>6.4} over {args.replicas} replicas")
+    sys.exit(0)
+
+  results = run_rollouts(files, args.controller, args.model_path, workers=workers, batch_size=args.batch_size, profile=args.profile,
+                         future_plan_lists=not args.future_plan_arrays, **model_options)
+  costs = [result[0] for result in results]
+
+  if args.results:
+    from results_store import ResultsStore, get_controller_hash, get_model_hash
+
+    with ResultsStore(args.results) as store:
+      store.put_many(args.controller, get_controller_hash(args.controller), get_model_hash(args.model_path, **model_options), zip(map(str, files), costs))
+  if args.profile:
+    print(profile_report([result[3] for result in results]))
+  if args.json:
+    for data_file, cost in zip(files, costs):
+      print(json.dumps({'segment': str(data_file), 'controller': args.controller, **{name: float(cost[name]) for name in COST_NAMES}}))
+  else:
+    means = {name: np.mean([cost[name] for cost in costs]) for name in COST_NAMES}
+    print(f"Average lataccel_cost: {means['lataccel_cost']:>6.4}, average jerk_cost: {means['jerk_cost']:>6.4}, average total_cost: {means['total_cost']:>6.4}")
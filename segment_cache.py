@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import numpy as np
+
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+from tqdm import tqdm
+
+COLUMNS = ['roll_lataccel', 'v_ego', 'a_ego', 'target_lataccel', 'steer_command']
+INDEX_FILE = 'segments.json'
+OFFSETS_FILE = 'offsets.npy'
+
+
+def get_cache_path(data_dir: Union[str, Path]) -> Path:
+  # kept next to the data directory, not inside it, so directory listings of segments stay unchanged
+  data_dir = Path(data_dir).absolute()
+  return data_dir.with_name(f"{data_dir.name}_cache")
+
+
+def get_file_stat(path: Union[str, Path]) -> List[int]:
+  stat = os.stat(path)
+  return [stat.st_size, stat.st_mtime_ns]
+
+
+class SegmentCache:
+  """
+  Preprocessed segments stored as one float64 .npy file per column plus a row offset per segment.
+  Columns are memory-mapped, so a segment is a zero-copy view into the files.
+  The index records each source CSV's size and mtime, so callers can tell when a segment is stale.
+  """
+  def __init__(self, cache_path: Union[str, Path]) -> None:
+    self.cache_path = Path(cache_path)
+    with open(self.cache_path / INDEX_FILE) as f:
+      index = json.load(f)
+    self.names = list(index)
+    self.stats = index
+    self.index = {name: i for i, name in enumerate(self.names)}
+    self.offsets = np.load(self.cache_path / OFFSETS_FILE)
+    self.columns = {col: np.load(self.cache_path / f"{col}.npy", mmap_mode='r') for col in COLUMNS}
+
+  def __contains__(self, name: str) -> bool:
+    return name in self.index
+
+  def __len__(self) -> int:
+    return len(self.names)
+
+  def is_fresh(self, name: str, data_path: Union[str, Path]) -> bool:
+    try:
+      return get_file_stat(data_path) == self.stats[name]
+    except FileNotFoundError:
+      return False
+
+  def get(self, name: str) -> Dict[str, np.ndarray]:
+    i = self.index[name]
+    start, end = self.offsets[i], self.offsets[i + 1]
+    return {col: values[start:end] for col, values in self.columns.items()}
+
+
+def write_cache(cache_path: Union[str, Path], names: List[str], segments: List[Dict[str, np.ndarray]], data_dir: Union[str, Path]) -> Path:
+  """
+  Writes segments (parsed from data_dir / name) as a cache, recording each source file's size and mtime.
+  """
+  cache_path = Path(cache_path)
+  offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(seg['target_lataccel']) for seg in segments])
+
+  cache_path.mkdir(parents=True, exist_ok=True)
+  for col in COLUMNS:
+    values = np.concatenate([seg[col] for seg in segments]) if segments else np.zeros(0)
+    np.save(cache_path / f"{col}.npy", values.astype(np.float64))
+  np.save(cache_path / OFFSETS_FILE, offsets)
+  # index is written last so a partially written cache is never picked up
+  with open(cache_path / INDEX_FILE, 'w') as f:
+    json.dump({name: get_file_stat(Path(data_dir) / name) for name in names}, f)
+  return cache_path
+
+
+def build_cache(data_dir: Union[str, Path], cache_path: Optional[Union[str, Path]] = None) -> Path:
+  from tinyphysics import read_csv
+
+  data_dir = Path(data_dir)
+  cache_path = Path(cache_path) if cache_path is not None else get_cache_path(data_dir)
+  files = sorted(f for f in data_dir.iterdir() if f.suffix == '.csv')
+  segments = [read_csv(f) for f in tqdm(files, desc="Parsing segments")]
+  return write_cache(cache_path, [f.name for f in files], segments, data_dir)
+
+
+_open_caches: Dict[Path, Optional[SegmentCache]] = {}
+
+
+def open_cache(data_dir: Union[str, Path]) -> Optional[SegmentCache]:
+  cache_path = get_cache_path(data_dir)
+  if cache_path not in _open_caches:
+    cache = SegmentCache(cache_path) if (cache_path / INDEX_FILE).exists() else None
+    if cache is not None and isinstance(cache.stats, list):
+      # caches written before the index recorded file stats can't be checked against the CSVs
+      print(f"Ignoring segment cache '{cache_path}' without file stats, rebuild it with segment_cache.py")
+      cache = None
+    _open_caches[cache_path] = cache
+  return _open_caches[cache_path]
+
+
+def load_cached_segment(data_path: Union[str, Path]) -> Optional[Dict[str, np.ndarray]]:
+  """
+  Zero-copy column views of a segment if the binary cache for its directory has it, else None.
+  A segment whose CSV changed size or mtime since the cache was built (edited, re-downloaded) is not served.
+  """
+  data_path = Path(data_path)
+  cache = open_cache(data_path.parent)
+  if cache is not None and data_path.name in cache and cache.is_fresh(data_path.name, data_path):
+    return cache.get(data_path.name)
+  return None
+
+
+class SharedSegmentStore:
+  """
+  Selected segments packed into one multiprocessing.shared_memory block as a [column, row] float64 array.
+  The parent loads every segment once with create(); pickling the store only sends the block's name and the index,
+  so a worker that receives it (e.g. through RolloutPool's initializer) attaches and reads segments as zero-copy,
+  read-only views, with no parsing and no per-worker copy of the data.
+  """
+  def __init__(self, shm: shared_memory.SharedMemory, keys: List[str], offsets: np.ndarray, owner: bool = False) -> None:
+    self.shm = shm
+    self.keys = keys
+    self.index = {key: i for i, key in enumerate(keys)}
+    self.offsets = offsets
+    self.owner = owner
+    self.values = np.ndarray((len(COLUMNS), offsets[-1]), dtype=np.float64, buffer=shm.buf)
+    if not owner:
+      self.values.setflags(write=False)
+
+  @staticmethod
+  def get_key(data_path: Union[str, Path]) -> str:
+    return os.path.abspath(data_path)
+
+  @classmethod
+  def create(cls, data_paths: List[Union[str, Path]]) -> 'SharedSegmentStore':
+    from tinyphysics import read_csv
+
+    keys = list(dict.fromkeys(cls.get_key(data_path) for data_path in data_paths))
+    segments = []
+    for key in tqdm(keys, desc="Sharing segments", disable=len(keys) < 100):
+      data = load_cached_segment(key)
+      segments.append(data if data is not None else read_csv(key))
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(seg['target_lataccel']) for seg in segments])
+    # a zero-size block is not allowed
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(COLUMNS) * int(offsets[-1]) * 8))
+    store = cls(shm, keys, offsets, owner=True)
+    for c, col in enumerate(COLUMNS):
+      for i, seg in enumerate(segments):
+        store.values[c, offsets[i]:offsets[i + 1]] = seg[col]
+    store.values.setflags(write=False)
+    return store
+
+  @classmethod
+  def attach(cls, name: str, keys: List[str], offsets: np.ndarray) -> 'SharedSegmentStore':
+    # workers share the parent's resource tracker, so attaching does not hand the block's cleanup to the worker
+    return cls(shared_memory.SharedMemory(name=name), keys, offsets)
+
+  def __reduce__(self):
+    return (SharedSegmentStore.attach, (self.shm.name, self.keys, self.offsets))
+
+  def __contains__(self, data_path: Union[str, Path]) -> bool:
+    return self.get_key(data_path) in self.index
+
+  def __len__(self) -> int:
+    return len(self.keys)
+
+  def get(self, data_path: Union[str, Path]) -> Optional[Dict[str, np.ndarray]]:
+    i = self.index.get(self.get_key(data_path))
+    if i is None:
+      return None
+    start, end = self.offsets[i], self.offsets[i + 1]
+    return {col: self.values[c, start:end] for c, col in enumerate(COLUMNS)}
+
+  def close(self) -> None:
+    """
+    Detaches, and frees the block if this process created it.
+    """
+    self.values = None
+    try:
+      self.shm.close()
+    except BufferError:
+      # segment views are still referenced; the mapping goes away with them
+      pass
+    if self.owner:
+      self.shm.unlink()
+      self.owner = False
+
+  def __enter__(self) -> 'SharedSegmentStore':
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+
+_shared_store: Optional[SharedSegmentStore] = None
+
+
+def use_shared_segments(store: Optional[SharedSegmentStore]) -> None:
+  """
+  Makes this process's segment loads read from store before the binary cache and the CSVs.
+  """
+  global _shared_store
+  _shared_store = store
+
+
+def load_shared_segment(data_path: Union[str, Path]) -> Optional[Dict[str, np.ndarray]]:
+  return _shared_store.get(data_path) if _shared_store is not None else None
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--data_path", type=str, required=True)
+  args = parser.parse_args()
+
+  cache_path = build_cache(args.data_path)
+  print(f"Segment cache saved to: '{cache_path}'")
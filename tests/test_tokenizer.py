@@ -0,0 +1,71 @@
+"""
+LataccelTokenizer.encode must match np.digitize(clip(value), bins, right=True) exactly, on every code path:
+scalars, small arrays (np.searchsorted) and large arrays (closed form). Run from the repository root:
+
+  python -m unittest discover -s tests -t .
+"""
+import unittest
+import numpy as np
+
+from tinyphysics import LATACCEL_RANGE, LataccelTokenizer
+
+
+def reference(tokenizer: LataccelTokenizer, values: np.ndarray) -> np.ndarray:
+  return np.digitize(np.clip(values, LATACCEL_RANGE[0], LATACCEL_RANGE[1]), tokenizer.bins, right=True)
+
+
+def edge_values(tokenizer: LataccelTokenizer, ulps: int = 64) -> np.ndarray:
+  # every bin edge walked ulps steps down and up, so each side of every comparison is hit
+  values = [tokenizer.bins]
+  down, up = tokenizer.bins.copy(), tokenizer.bins.copy()
+  for _ in range(ulps):
+    down, up = np.nextafter(down, -np.inf), np.nextafter(up, np.inf)
+    values += [down, up]
+  values.append((tokenizer.bins[1:] + tokenizer.bins[:-1]) / 2)
+  # the ideal uniform grid, which differs from linspace in the last bit for some edges
+  values.append(LATACCEL_RANGE[0] + np.arange(tokenizer.vocab_size) / tokenizer.inv_step)
+  values.append(special_values())
+  return np.concatenate(values)
+
+
+def special_values() -> np.ndarray:
+  tiny = np.finfo(np.float64).tiny
+  return np.array([-np.inf, np.inf, np.nan, -0.0, 0.0, -1e300, 1e300, tiny, -tiny, LATACCEL_RANGE[0], LATACCEL_RANGE[1]])
+
+
+class TestLataccelTokenizer(unittest.TestCase):
+  def setUp(self):
+    self.tokenizer = LataccelTokenizer()
+    rng = np.random.RandomState(0)
+    self.values = np.concatenate([edge_values(self.tokenizer), rng.uniform(LATACCEL_RANGE[0] - 1, LATACCEL_RANGE[1] + 1, 10**5)])
+    self.expected = reference(self.tokenizer, self.values)
+
+  def assertTokens(self, tokens, expected):
+    self.assertEqual(tokens.dtype, np.int64)
+    mismatches = np.flatnonzero(tokens != expected)
+    self.assertEqual(len(mismatches), 0, f"{len(mismatches)} mismatches, first at index {mismatches[:1]}")
+
+  def test_large_array(self):
+    self.assertGreater(self.values.size, LataccelTokenizer.SEARCH_SIZE)
+    self.assertTokens(self.tokenizer.encode(self.values), self.expected)
+    # batched [B, T] inputs
+    self.assertTokens(self.tokenizer.encode(self.values.reshape(-1, 1)).ravel(), self.expected)
+
+  def test_small_arrays(self):
+    size = LataccelTokenizer.SEARCH_SIZE
+    tokens = np.concatenate([self.tokenizer.encode(self.values[i:i + size]) for i in range(0, len(self.values), size)])
+    self.assertTokens(tokens, self.expected)
+    self.assertTokens(self.tokenizer.encode(special_values().reshape(1, -1)).ravel(), reference(self.tokenizer, special_values()))
+
+  def test_scalars(self):
+    tokens = np.array([self.tokenizer.encode(value) for value in self.values.tolist()])
+    self.assertTokens(tokens, self.expected)
+    self.assertEqual(self.tokenizer.encode(np.float64(0.5)), reference(self.tokenizer, np.array([0.5]))[0])
+
+  def test_decode_roundtrip(self):
+    tokens = np.arange(self.tokenizer.vocab_size)
+    self.assertTokens(self.tokenizer.encode(self.tokenizer.decode(tokens)), tokens)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,26 +1,25 @@
 import argparse
 import importlib
+import math
 import numpy as np
-import onnxruntime as ort
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import signal
-import urllib.request
-import zipfile
 
-from io import BytesIO
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 from hashlib import md5
 from pathlib import Path
-from typing import List, Union, Tuple, Dict
-from tqdm.contrib.concurrent import process_map
+from typing import Dict, Iterator, List, Tuple, Union
+from tqdm import tqdm
 
-from controllers import BaseController
+from controllers import BaseBatchController, BaseController
+from inference import get_backend
+from profiling import StepProfiler, profile_report
+from segment_cache import SharedSegmentStore, load_cached_segment, load_shared_segment, use_shared_segments
 
-sns.set_theme()
+# plotting (matplotlib, seaborn), pandas and the dataset download are imported where they are used, so headless
+# rollouts and every pool worker skip their import cost; benchmarks/bench_import.py keeps track of it
 signal.signal(signal.SIGINT, signal.SIG_DFL)  # Enable Ctrl-C on plot windows
 
 ACC_G = 9.81
@@ -43,14 +42,62 @@ FuturePlan = namedtuple('FuturePlan', ['lataccel', 'roll_lataccel', 'v_ego', 'a_
 DATASET_URL = "https://huggingface.co/datasets/commaai/commaSteeringControl/resolve/main/data/SYNTHETIC_V0.zip"
 DATASET_PATH = Path(__file__).resolve().parent / "data"
 
+def get_pyplot():
+  import matplotlib.pyplot as plt
+  import seaborn as sns
+
+  sns.set_theme()
+  return plt
+
+
 class LataccelTokenizer:
+  """
+  encode is np.digitize(clip(value), bins, right=True), i.e. the first bin >= value, computed in O(1) on the
+  uniform grid: a closed-form guess ceil((value - low) / step) followed by one correction step against the actual
+  linspace values, which can differ from the ideal grid in the last bit. Arrays of up to SEARCH_SIZE values
+  (e.g. the [B] values appended per batched sim step) use np.searchsorted instead, which is cheaper at that size.
+  tests/test_tokenizer.py checks both paths against np.digitize at and around every bin edge.
+  """
+  SEARCH_SIZE = 512
+
   def __init__(self):
     self.vocab_size = VOCAB_SIZE
     self.bins = np.linspace(LATACCEL_RANGE[0], LATACCEL_RANGE[1], self.vocab_size)
+    self.inv_step = (self.vocab_size - 1) / (LATACCEL_RANGE[1] - LATACCEL_RANGE[0])
+    # lower_bins[t] = bins[t - 1], with -inf below the first bin so no token is corrected below 0
+    self.lower_bins = np.concatenate([[-np.inf], self.bins[:-1]])
+    self.bins_list = self.bins.tolist()
 
   def encode(self, value: Union[float, np.ndarray, List[float]]) -> Union[int, np.ndarray]:
-    value = self.clip(value)
-    return np.digitize(value, self.bins, right=True)
+    if isinstance(value, float) or np.ndim(value) == 0:
+      return np.int64(self.encode_scalar(float(value)))
+    value = np.minimum(np.maximum(value, LATACCEL_RANGE[0]), LATACCEL_RANGE[1])
+    if value.size <= self.SEARCH_SIZE:
+      # first bin >= value; NaN sorts past the last bin, as in np.digitize
+      return np.searchsorted(self.bins, value, side='left').astype(np.int64, copy=False)
+    nan = np.isnan(value)
+    if nan.any():
+      # np.digitize sorts NaN past the last bin
+      token = self.encode(np.where(nan, LATACCEL_RANGE[1], value))
+      token[nan] = self.vocab_size
+      return token
+    token = np.ceil((value - LATACCEL_RANGE[0]) * self.inv_step).astype(np.int64)
+    np.minimum(token, self.vocab_size - 1, out=token)
+    token += self.bins[token] < value
+    token -= self.lower_bins[token] >= value
+    return token
+
+  def encode_scalar(self, value: float) -> int:
+    # plain float arithmetic: several times faster than the array path for the one value appended per sim step
+    if value != value:
+      return self.vocab_size
+    value = min(max(value, LATACCEL_RANGE[0]), LATACCEL_RANGE[1])
+    token = min(math.ceil((value - LATACCEL_RANGE[0]) * self.inv_step), self.vocab_size - 1)
+    if self.bins_list[token] < value:
+      token += 1
+    elif token > 0 and self.bins_list[token - 1] >= value:
+      token -= 1
+    return token
 
   def decode(self, token: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
     return self.bins[token]
@@ -60,29 +107,54 @@ class LataccelTokenizer:
 
 
 class TinyPhysicsModel:
-  def __init__(self, model_path: str, debug: bool) -> None:
+  def __init__(self, model_path: str, debug: bool, sampling: str = 'exact', backend: str = 'ort', **backend_options) -> None:
     self.tokenizer = LataccelTokenizer()
-    options = ort.SessionOptions()
-    options.intra_op_num_threads = 1
-    options.inter_op_num_threads = 1
-    options.log_severity_level = 3
-    provider = 'CPUExecutionProvider'
-
-    with open(model_path, "rb") as f:
-      self.ort_session = ort.InferenceSession(f.read(), options, [provider])
+    # 'exact' reproduces the np.random.choice draws of the original sampler bit for bit,
+    # 'fast' skips the float64 normalization and may pick a neighbouring token on rare ties
+    assert sampling in ('exact', 'fast')
+    self.sampling = sampling
+    # see inference.OrtBackend for the session options (threads, graph optimization, IOBinding)
+    self.backend = get_backend(backend, model_path, **backend_options)
 
   def softmax(self, x, axis=-1):
     e_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
     return e_x / np.sum(e_x, axis=axis, keepdims=True)
 
+  def sample(self, logits: np.ndarray, draws: np.ndarray, temperature=1.) -> np.ndarray:
+    """
+    Inverse-CDF sampling of one token per row.
+    Args:
+      logits: [B, VOCAB_SIZE] logits of the last timestep.
+      draws: [B] uniform samples in [0, 1).
+    Returns:
+      [B] sampled tokens.
+    """
+    x = logits / temperature
+    if self.sampling == 'exact':
+      # same arithmetic as np.random.choice(p=softmax(x)): float64 cumsum normalized by its last entry
+      cdf = self.softmax(x, axis=-1).astype(np.float64).cumsum(axis=-1)
+      cdf /= cdf[:, -1:]
+    else:
+      cdf = np.exp(x - np.max(x, axis=-1, keepdims=True)).cumsum(axis=-1)
+      draws = draws * cdf[:, -1]
+      # should the scaled draw round up to the total, every token would count and decode would index past the vocabulary
+      return np.minimum((cdf <= draws[:, None]).sum(axis=-1), VOCAB_SIZE - 1)
+    # the cdf is non-decreasing, so this equals cdf.searchsorted(draw, side='right') per row
+    return (cdf <= draws[:, None]).sum(axis=-1)
+
   def predict(self, input_data: dict, temperature=1.) -> int:
-    res = self.ort_session.run(None, input_data)[0]
-    probs = self.softmax(res / temperature, axis=-1)
+    res = self.backend.run(input_data)
     # we only care about the last timestep (batch size is just 1)
-    assert probs.shape[0] == 1
-    assert probs.shape[2] == VOCAB_SIZE
-    sample = np.random.choice(probs.shape[2], p=probs[0, -1])
-    return sample
+    assert res.shape[0] == 1
+    assert res.shape[2] == VOCAB_SIZE
+    return self.sample(res[:, -1], np.array([np.random.random_sample()]), temperature)[0]
+
+  def predict_batch(self, input_data: dict, rngs: List[np.random.RandomState], temperature=1.) -> np.ndarray:
+    res = self.backend.run(input_data)
+    # one row per segment, each sampled from its own random stream
+    assert res.shape[0] == len(rngs)
+    assert res.shape[2] == VOCAB_SIZE
+    return self.sample(res[:, -1], np.array([rng.random_sample() for rng in rngs]), temperature)
 
   def get_current_lataccel(self, sim_states: List[State], actions: List[float], past_preds: List[float]) -> float:
     tokenized_actions = self.tokenizer.encode(past_preds)
@@ -94,81 +166,247 @@ class TinyPhysicsModel:
     }
     return self.tokenizer.decode(self.predict(input_data, temperature=0.8))
 
+  def get_current_lataccel_from_inputs(self, sim_inputs: np.ndarray, past_preds: np.ndarray) -> float:
+    """
+    get_current_lataccel for a prebuilt model input window.
+    Args:
+      sim_inputs: [CONTEXT_LENGTH, 4] float32 rows of (action, roll_lataccel, v_ego, a_ego).
+      past_preds: [CONTEXT_LENGTH] past lataccels.
+    Returns:
+      The predicted lataccel.
+    """
+    return self.get_current_lataccel_from_tokens(sim_inputs, self.tokenizer.encode(past_preds))
+
+  def get_current_lataccel_from_tokens(self, sim_inputs: np.ndarray, past_tokens: np.ndarray) -> float:
+    """
+    get_current_lataccel_from_inputs with the past lataccels already encoded as [CONTEXT_LENGTH] int64 tokens.
+    """
+    input_data = {
+      'states': sim_inputs[None],
+      'tokens': past_tokens[None]
+    }
+    return self.tokenizer.decode(self.predict(input_data, temperature=0.8))
+
+  def get_current_lataccels(self, sim_inputs: np.ndarray, past_preds: np.ndarray, rngs: List[np.random.RandomState]) -> np.ndarray:
+    """
+    Batched get_current_lataccel_from_inputs.
+    Args:
+      sim_inputs: [B, CONTEXT_LENGTH, 4] float32 rows of (action, roll_lataccel, v_ego, a_ego).
+      past_preds: [B, CONTEXT_LENGTH] past lataccels.
+      rngs: one random stream per row.
+    Returns:
+      [B] predicted lataccels.
+    """
+    return self.get_current_lataccels_from_tokens(sim_inputs, self.tokenizer.encode(past_preds), rngs)
+
+  def get_current_lataccels_from_tokens(self, sim_inputs: np.ndarray, past_tokens: np.ndarray, rngs: List[np.random.RandomState]) -> np.ndarray:
+    """
+    get_current_lataccels with the past lataccels already encoded as [B, CONTEXT_LENGTH] int64 tokens.
+    """
+    input_data = {
+      'states': sim_inputs,
+      'tokens': past_tokens
+    }
+    return self.tokenizer.decode(self.predict_batch(input_data, rngs, temperature=0.8))
+
+
+def read_only(values: np.ndarray) -> np.ndarray:
+  values = np.ascontiguousarray(values).view(np.ndarray)
+  values.setflags(write=False)
+  return values
+
+
+def read_csv(data_path: str) -> Dict[str, np.ndarray]:
+  import pandas as pd
+
+  df = pd.read_csv(data_path)
+  return {
+    'roll_lataccel': np.sin(df['roll'].values) * ACC_G,
+    'v_ego': df['vEgo'].values,
+    'a_ego': df['aEgo'].values,
+    'target_lataccel': df['targetLateralAcceleration'].values,
+    'steer_command': -df['steerCommand'].values  # steer commands are logged with left-positive convention but this simulator uses right-positive
+  }
+
+
+def get_seed(data_path: str) -> int:
+  return int(md5(data_path.encode()).hexdigest(), 16) % 10**4
+
+
+def get_replica_seed(data_path: str, replica: int):
+  # replica 0 is the regular rollout; the others get independent streams derived from the segment's seed
+  return get_seed(data_path) if replica == 0 else [get_seed(data_path), replica]
+
+
+def get_file_hash(path: str) -> str:
+  with open(path, "rb") as f:
+    return md5(f.read()).hexdigest()
+
+
+def get_cost(target_lataccel_history, current_lataccel_history) -> Dict[str, float]:
+  # histories are usually arrays already, so only the cost window is read and nothing is copied
+  target = np.asarray(target_lataccel_history)[CONTROL_START_IDX:COST_END_IDX]
+  pred = np.asarray(current_lataccel_history)[CONTROL_START_IDX:COST_END_IDX]
+
+  lat_accel_cost = np.mean((target - pred)**2) * 100
+  jerk_cost = np.mean((np.diff(pred) / DEL_T)**2) * 100
+  total_cost = (lat_accel_cost * LAT_ACCEL_COST_MULTIPLIER) + jerk_cost
+  return {'lataccel_cost': lat_accel_cost, 'jerk_cost': jerk_cost, 'total_cost': total_cost}
+
+
+def get_cost_window(num_steps):
+  return np.minimum(num_steps, COST_END_IDX) - CONTROL_START_IDX
+
+
+def get_mean_cost(lataccel_sq_sum, jerk_sq_sum, lataccel_steps) -> Dict[str, float]:
+  lat_accel_cost = lataccel_sq_sum / np.maximum(lataccel_steps, 1) * 100
+  jerk_cost = jerk_sq_sum / np.maximum(lataccel_steps - 1, 1) * 100
+  total_cost = (lat_accel_cost * LAT_ACCEL_COST_MULTIPLIER) + jerk_cost
+  return {'lataccel_cost': lat_accel_cost, 'jerk_cost': jerk_cost, 'total_cost': total_cost}
+
+
+class CostAccumulator:
+  """
+  Running squared lataccel and jerk errors over the cost window, updated as a rollout steps.
+  num_steps is a segment length, or an array of lengths to accumulate a batch of rollouts elementwise.
+  The sums are added up in step order, so costs derived from them can differ from get_cost's in the last bits;
+  get_cost stays the reference for final costs.
+  """
+  def __init__(self, num_steps) -> None:
+    self.window = get_cost_window(np.asarray(num_steps))
+    self.lataccel_sq_sum = np.zeros(np.shape(num_steps))
+    self.jerk_sq_sum = np.zeros(np.shape(num_steps))
+    self.steps = np.zeros(np.shape(num_steps), dtype=int)
+
+  def update(self, step_idx: int, target, current, previous, rows=...) -> None:
+    if CONTROL_START_IDX <= step_idx < COST_END_IDX:
+      self.lataccel_sq_sum[rows] += (target - current) ** 2
+      if step_idx > CONTROL_START_IDX:
+        self.jerk_sq_sum[rows] += ((current - previous) / DEL_T) ** 2
+      self.steps[rows] += 1
+
+  def partial_cost(self) -> Dict[str, float]:
+    # mean costs over the part of the cost window seen so far
+    return {name: value[()] for name, value in get_mean_cost(self.lataccel_sq_sum, self.jerk_sq_sum, self.steps).items()}
+
+  def lower_bound(self) -> Dict[str, float]:
+    # squared errors are non-negative, so dividing the partial sums by the full window bounds the final costs from below
+    return {name: value[()] for name, value in get_mean_cost(self.lataccel_sq_sum, self.jerk_sq_sum, self.window).items()}
+
+  def pruned_cost(self, step_idx: int, row=...) -> Dict[str, float]:
+    # costs of a pruned rollout are lower bounds, not the costs it would have reached
+    bound = get_mean_cost(self.lataccel_sq_sum[row], self.jerk_sq_sum[row], self.window[row])
+    return {**bound, 'pruned': True, 'pruned_at': int(step_idx)}
+
 
 class TinyPhysicsSimulator:
-  def __init__(self, model: TinyPhysicsModel, data_path: str, controller: BaseController, debug: bool = False) -> None:
+  def __init__(self, model: TinyPhysicsModel, data_path: str, controller: BaseController, debug: bool = False, future_plan_lists: bool = True) -> None:
     self.data_path = data_path
     self.sim_model = model
     self.data = self.get_data(data_path)
+    # contiguous, read-only columns; states and future plans are served as views into these
+    self.roll_lataccel, self.v_ego, self.a_ego, self.target_lataccel, self.steer_command = (
+      read_only(self.data[col]) for col in ['roll_lataccel', 'v_ego', 'a_ego', 'target_lataccel', 'steer_command'])
+    self.states = read_only(np.stack([self.roll_lataccel, self.v_ego, self.a_ego], axis=1))
+    self.num_steps = len(self.target_lataccel)
     self.controller = controller
     self.debug = debug
+    # FuturePlan fields are lists by default, as controllers have always received them; False serves read-only
+    # ndarray views instead, which skips a conversion per step for controllers that handle arrays
+    self.future_plan_lists = future_plan_lists
     self.reset()
 
   def reset(self) -> None:
     self.step_idx = CONTEXT_LENGTH
-    state_target_futureplans = [self.get_state_target_futureplan(i) for i in range(self.step_idx)]
-    self.state_history = [x[0] for x in state_target_futureplans]
-    self.action_history = self.data['steer_command'].values[:self.step_idx].tolist()
-    self.current_lataccel_history = [x[1] for x in state_target_futureplans]
-    self.target_lataccel_history = [x[1] for x in state_target_futureplans]
+    # histories are preallocated for the whole segment; the first step_idx entries are filled
+    self.actions = np.zeros(self.num_steps)
+    self.actions[:self.step_idx] = self.steer_command[:self.step_idx]
+    self.current_lataccels = np.zeros(self.num_steps)
+    self.current_lataccels[:self.step_idx] = self.target_lataccel[:self.step_idx]
+    # model input rows (action, roll_lataccel, v_ego, a_ego), so a context window is a plain slice
+    self.sim_inputs = np.empty((self.num_steps, 4), dtype=np.float32)
+    self.sim_inputs[:, 0] = self.actions
+    self.sim_inputs[:, 1:] = self.states
     self.target_future = None
-    self.current_lataccel = self.current_lataccel_history[-1]
-    seed = int(md5(self.data_path.encode()).hexdigest(), 16) % 10**4
-    np.random.seed(seed)
-
-  def get_data(self, data_path: str) -> pd.DataFrame:
-    df = pd.read_csv(data_path)
-    processed_df = pd.DataFrame({
-      'roll_lataccel': np.sin(df['roll'].values) * ACC_G,
-      'v_ego': df['vEgo'].values,
-      'a_ego': df['aEgo'].values,
-      'target_lataccel': df['targetLateralAcceleration'].values,
-      'steer_command': -df['steerCommand'].values  # steer commands are logged with left-positive convention but this simulator uses right-positive
-    })
-    return processed_df
+    self.current_lataccel = self.current_lataccels[self.step_idx - 1]
+    # model tokens of current_lataccels, encoded once when a lataccel is appended instead of once per context window
+    self.tokens = np.zeros(self.num_steps, dtype=np.int64)
+    self.tokens[:self.step_idx] = self.sim_model.tokenizer.encode(self.current_lataccels[:self.step_idx])
+    # running costs, for pruning rollouts on a cost budget and for streaming partial costs
+    self.cost_accumulator = CostAccumulator(self.num_steps)
+    np.random.seed(get_seed(self.data_path))
+
+  @property
+  def state_history(self) -> np.ndarray:
+    return self.states[:self.step_idx]
+
+  @property
+  def action_history(self) -> np.ndarray:
+    return self.actions[:self.step_idx]
+
+  @property
+  def current_lataccel_history(self) -> np.ndarray:
+    return self.current_lataccels[:self.step_idx]
+
+  @property
+  def target_lataccel_history(self) -> np.ndarray:
+    return self.target_lataccel[:self.step_idx]
+
+  @staticmethod
+  def get_data(data_path: str) -> Dict[str, np.ndarray]:
+    data = load_shared_segment(data_path)
+    if data is None:
+      data = load_cached_segment(data_path)
+    if data is None:
+      data = read_csv(data_path)
+    return data
 
   def sim_step(self, step_idx: int) -> None:
-    pred = self.sim_model.get_current_lataccel(
-      sim_states=self.state_history[-CONTEXT_LENGTH:],
-      actions=self.action_history[-CONTEXT_LENGTH:],
-      past_preds=self.current_lataccel_history[-CONTEXT_LENGTH:]
+    pred = self.sim_model.get_current_lataccel_from_tokens(
+      sim_inputs=self.sim_inputs[step_idx - CONTEXT_LENGTH + 1:step_idx + 1],
+      past_tokens=self.tokens[step_idx - CONTEXT_LENGTH:step_idx]
     )
     pred = np.clip(pred, self.current_lataccel - MAX_ACC_DELTA, self.current_lataccel + MAX_ACC_DELTA)
     if step_idx >= CONTROL_START_IDX:
       self.current_lataccel = pred
     else:
-      self.current_lataccel = self.get_state_target_futureplan(step_idx)[1]
+      self.current_lataccel = self.target_lataccel[step_idx]
 
-    self.current_lataccel_history.append(self.current_lataccel)
+    self.current_lataccels[step_idx] = self.current_lataccel
+    self.tokens[step_idx] = self.sim_model.tokenizer.encode(self.current_lataccel)
+    self.cost_accumulator.update(step_idx, self.target_lataccel[step_idx], self.current_lataccel, self.current_lataccels[step_idx - 1])
 
   def control_step(self, step_idx: int) -> None:
     # control the car (towards these targets)
     # goal is to drive car exactly on trajectoryß
     
-    action = self.controller.update(self.target_lataccel_history[step_idx], self.current_lataccel, self.state_history[step_idx], future_plan=self.futureplan)
+    action = self.controller.update(self.target_lataccel[step_idx], self.current_lataccel, self.get_state(step_idx), future_plan=self.futureplan)
     if step_idx < CONTROL_START_IDX:
-      action = self.data['steer_command'].values[step_idx]
+      action = self.steer_command[step_idx]
     action = np.clip(action, STEER_RANGE[0], STEER_RANGE[1])
-    self.action_history.append(action)
+    self.actions[step_idx] = action
+    self.sim_inputs[step_idx, 0] = action
+
+  def get_state(self, step_idx: int) -> State:
+    return State(roll_lataccel=self.roll_lataccel[step_idx], v_ego=self.v_ego[step_idx], a_ego=self.a_ego[step_idx])
+
+  def get_futureplan(self, step_idx: int) -> FuturePlan:
+    future = slice(step_idx + 1, step_idx + FUTURE_PLAN_STEPS)
+    futureplan = FuturePlan(
+      lataccel=self.target_lataccel[future],
+      roll_lataccel=self.roll_lataccel[future],
+      v_ego=self.v_ego[future],
+      a_ego=self.a_ego[future]
+    )
+    if self.future_plan_lists:
+      futureplan = FuturePlan(*(x.tolist() for x in futureplan))
+    return futureplan
 
   def get_state_target_futureplan(self, step_idx: int) -> Tuple[State, float, FuturePlan]:
-    state = self.data.iloc[step_idx]
-    return (
-      State(roll_lataccel=state['roll_lataccel'], v_ego=state['v_ego'], a_ego=state['a_ego']),
-      state['target_lataccel'],
-      FuturePlan(
-        lataccel=self.data['target_lataccel'].values[step_idx + 1:step_idx + FUTURE_PLAN_STEPS].tolist(),
-        roll_lataccel=self.data['roll_lataccel'].values[step_idx + 1:step_idx + FUTURE_PLAN_STEPS].tolist(),
-        v_ego=self.data['v_ego'].values[step_idx + 1:step_idx + FUTURE_PLAN_STEPS].tolist(),
-        a_ego=self.data['a_ego'].values[step_idx + 1:step_idx + FUTURE_PLAN_STEPS].tolist()
-      )
-    )
+    return self.get_state(step_idx), self.target_lataccel[step_idx], self.get_futureplan(step_idx)
 
   def step(self) -> None:
-    state, target, futureplan = self.get_state_target_futureplan(self.step_idx)
-    self.state_history.append(state)
-    self.target_lataccel_history.append(target)
-    self.futureplan = futureplan
+    self.futureplan = self.get_futureplan(self.step_idx)
     self.control_step(self.step_idx)
     self.sim_step(self.step_idx)
     self.step_idx += 1
@@ -184,27 +422,43 @@ class TinyPhysicsSimulator:
     ax.set_ylabel(axis_labels[1])
 
   def compute_cost(self) -> Dict[str, float]:
-    target = np.array(self.target_lataccel_history)[CONTROL_START_IDX:COST_END_IDX]
-    pred = np.array(self.current_lataccel_history)[CONTROL_START_IDX:COST_END_IDX]
-
-    lat_accel_cost = np.mean((target - pred)**2) * 100
-    jerk_cost = np.mean((np.diff(pred) / DEL_T)**2) * 100
-    total_cost = (lat_accel_cost * LAT_ACCEL_COST_MULTIPLIER) + jerk_cost
-    return {'lataccel_cost': lat_accel_cost, 'jerk_cost': jerk_cost, 'total_cost': total_cost}
-
-  def rollout(self) -> Dict[str, float]:
+    return get_cost(self.target_lataccel_history, self.current_lataccel_history)
+
+  def stream(self, every: int = 1, stop_at_cost_end: bool = False) -> Iterator[Tuple[int, Dict[str, float]]]:
+    """
+    Steps the rollout, yielding (step_idx, costs so far) every `every` steps and after the last one.
+    Stop iterating to abandon the rollout; compute_cost() gives the exact costs once it has finished.
+    """
+    end = min(self.num_steps, COST_END_IDX) if stop_at_cost_end else self.num_steps
+    for _ in range(CONTEXT_LENGTH, end):
+      self.step()
+      if (self.step_idx - CONTEXT_LENGTH) % every == 0 or self.step_idx == end:
+        yield self.step_idx, self.cost_accumulator.partial_cost()
+
+  def rollout(self, cost_budget: float = None, stop_at_cost_end: bool = False) -> Dict[str, float]:
+    """
+    Args:
+      cost_budget: stop as soon as total_cost is certain to exceed it, and return a record marked 'pruned'.
+      stop_at_cost_end: skip the steps after COST_END_IDX, which do not count towards the cost.
+    """
     if self.debug:
+      plt = get_pyplot()
       plt.ion()
       fig, ax = plt.subplots(4, figsize=(12, 14), constrained_layout=True)
 
-    for _ in range(CONTEXT_LENGTH, len(self.data)):
+    end = min(self.num_steps, COST_END_IDX) if stop_at_cost_end else self.num_steps
+    for _ in range(CONTEXT_LENGTH, end):
       self.step()
+      if cost_budget is not None and self.cost_accumulator.lower_bound()['total_cost'] > cost_budget:
+        if self.debug:
+          plt.ioff()
+        return self.cost_accumulator.pruned_cost(self.step_idx)
       if self.debug and self.step_idx % 10 == 0:
         print(f"Step {self.step_idx:<5}: Current lataccel: {self.current_lataccel:>6.2f}, Target lataccel: {self.target_lataccel_history[-1]:>6.2f}")
         self.plot_data(ax[0], [(self.target_lataccel_history, 'Target lataccel'), (self.current_lataccel_history, 'Current lataccel')], ['Step', 'Lateral Acceleration'], 'Lateral Acceleration')
         self.plot_data(ax[1], [(self.action_history, 'Action')], ['Step', 'Action'], 'Action')
-        self.plot_data(ax[2], [(np.array(self.state_history)[:, 0], 'Roll Lateral Acceleration')], ['Step', 'Lateral Accel due to Road Roll'], 'Lateral Accel due to Road Roll')
-        self.plot_data(ax[3], [(np.array(self.state_history)[:, 1], 'v_ego')], ['Step', 'v_ego'], 'v_ego')
+        self.plot_data(ax[2], [(self.state_history[:, 0], 'Roll Lateral Acceleration')], ['Step', 'Lateral Accel due to Road Roll'], 'Lateral Accel due to Road Roll')
+        self.plot_data(ax[3], [(self.state_history[:, 1], 'v_ego')], ['Step', 'v_ego'], 'v_ego')
         plt.pause(0.01)
 
     if self.debug:
@@ -213,26 +467,289 @@ class TinyPhysicsSimulator:
     return self.compute_cost()
 
 
+class BatchedTinyPhysicsSimulator:
+  """
+  Steps B segments in lockstep so every sim step is a single batched model call.
+  Each segment keeps its own seeded random stream, so costs match TinyPhysicsSimulator exactly.
+  Segments shorter than the longest one are masked out once they run out of data.
+  seeds overrides the per-row seeds (default get_seed(data_path)), e.g. to run Monte Carlo replicas of a segment.
+  controllers is either one BaseController per row, or a single BaseBatchController called once per step for all rows.
+  """
+  def __init__(self, model: TinyPhysicsModel, data_paths: List[str], controllers: Union[List[BaseController], BaseBatchController],
+               future_plan_lists: bool = True, seeds: List = None) -> None:
+    self.batch_controller = controllers if isinstance(controllers, BaseBatchController) else None
+    if self.batch_controller is not None:
+      controllers = [self.batch_controller]
+    else:
+      assert len(data_paths) == len(controllers)
+    assert seeds is None or len(seeds) == len(data_paths)
+    self.data_paths = data_paths
+    self.seeds = seeds if seeds is not None else [get_seed(data_path) for data_path in data_paths]
+    self.sim_model = model
+    self.controllers = controllers
+    self.future_plan_lists = future_plan_lists
+    # rows that share a segment (e.g. many controllers on one segment) share its loaded data
+    segments = {data_path: TinyPhysicsSimulator.get_data(data_path) for data_path in dict.fromkeys(data_paths)}
+    self.data = [segments[data_path] for data_path in data_paths]
+    self.lengths = np.array([len(data['target_lataccel']) for data in self.data])
+    self.reset()
+
+  def reset(self) -> None:
+    batch_size, max_len = len(self.data), self.lengths.max()
+    self.step_idx = CONTEXT_LENGTH
+    self.roll_lataccel = np.zeros((batch_size, max_len))
+    self.v_ego = np.zeros((batch_size, max_len))
+    self.a_ego = np.zeros((batch_size, max_len))
+    self.target_lataccel = np.zeros((batch_size, max_len))
+    self.steer_command = np.zeros((batch_size, max_len))
+    for i, data in enumerate(self.data):
+      n = self.lengths[i]
+      self.roll_lataccel[i, :n] = data['roll_lataccel']
+      self.v_ego[i, :n] = data['v_ego']
+      self.a_ego[i, :n] = data['a_ego']
+      self.target_lataccel[i, :n] = data['target_lataccel']
+      self.steer_command[i, :n] = data['steer_command']
+    for values in [self.roll_lataccel, self.v_ego, self.a_ego, self.target_lataccel, self.steer_command]:
+      values.setflags(write=False)
+    if self.batch_controller is not None:
+      # NaN past each row's end, and FUTURE_PLAN_STEPS of room past the longest, so every future plan is a fixed-width view
+      self.future_padded = {}
+      for name, values in [('lataccel', self.target_lataccel), ('roll_lataccel', self.roll_lataccel), ('v_ego', self.v_ego), ('a_ego', self.a_ego)]:
+        padded = np.full((batch_size, max_len + FUTURE_PLAN_STEPS), np.nan)
+        for i, n in enumerate(self.lengths):
+          padded[i, :n] = values[i, :n]
+        padded.setflags(write=False)
+        self.future_padded[name] = padded
+
+    self.action_history = np.zeros((batch_size, max_len))
+    self.action_history[:, :self.step_idx] = self.steer_command[:, :self.step_idx]
+    self.sim_inputs = np.stack([self.action_history, self.roll_lataccel, self.v_ego, self.a_ego], axis=-1).astype(np.float32)
+    self.current_lataccel_history = np.zeros((batch_size, max_len))
+    self.current_lataccel_history[:, :self.step_idx] = self.target_lataccel[:, :self.step_idx]
+    self.current_lataccel = self.current_lataccel_history[:, self.step_idx - 1].copy()
+    self.tokens = np.zeros((batch_size, max_len), dtype=np.int64)
+    self.tokens[:, :self.step_idx] = self.sim_model.tokenizer.encode(self.current_lataccel_history[:, :self.step_idx])
+    self.rngs = [np.random.RandomState(seed) for seed in self.seeds]
+    self.cost_accumulator = CostAccumulator(self.lengths)
+    # step at which a row was pruned on its cost budget, 0 while it is still running
+    self.pruned_at = np.zeros(batch_size, dtype=int)
+
+  def get_state_target_futureplan(self, i: int, step_idx: int) -> Tuple[State, float, FuturePlan]:
+    future = slice(step_idx + 1, min(step_idx + FUTURE_PLAN_STEPS, self.lengths[i]))
+    futureplan = FuturePlan(
+      lataccel=self.target_lataccel[i, future],
+      roll_lataccel=self.roll_lataccel[i, future],
+      v_ego=self.v_ego[i, future],
+      a_ego=self.a_ego[i, future]
+    )
+    if self.future_plan_lists:
+      futureplan = FuturePlan(*(x.tolist() for x in futureplan))
+    return (
+      State(roll_lataccel=self.roll_lataccel[i, step_idx], v_ego=self.v_ego[i, step_idx], a_ego=self.a_ego[i, step_idx]),
+      self.target_lataccel[i, step_idx],
+      futureplan
+    )
+
+  def get_batch_state_target_futureplan(self, step_idx: int) -> Tuple[State, np.ndarray, FuturePlan]:
+    future = slice(step_idx + 1, step_idx + FUTURE_PLAN_STEPS)
+    return (
+      State(roll_lataccel=self.roll_lataccel[:, step_idx], v_ego=self.v_ego[:, step_idx], a_ego=self.a_ego[:, step_idx]),
+      self.target_lataccel[:, step_idx],
+      FuturePlan(**{name: padded[:, future] for name, padded in self.future_padded.items()})
+    )
+
+  def control_step(self, step_idx: int, active: np.ndarray) -> None:
+    if self.batch_controller is not None:
+      state, target, futureplan = self.get_batch_state_target_futureplan(step_idx)
+      actions = np.asarray(self.batch_controller.update(target, self.current_lataccel.copy(), state, future_plan=futureplan), dtype=np.float64)
+      if step_idx < CONTROL_START_IDX:
+        actions = self.steer_command[:, step_idx]
+      self.action_history[active, step_idx] = np.clip(actions[active], STEER_RANGE[0], STEER_RANGE[1])
+      self.sim_inputs[active, step_idx, 0] = self.action_history[active, step_idx]
+      return
+    for i in active:
+      state, target, futureplan = self.get_state_target_futureplan(i, step_idx)
+      action = self.controllers[i].update(target, self.current_lataccel[i], state, future_plan=futureplan)
+      if step_idx < CONTROL_START_IDX:
+        action = self.steer_command[i, step_idx]
+      self.action_history[i, step_idx] = np.clip(action, STEER_RANGE[0], STEER_RANGE[1])
+    self.sim_inputs[active, step_idx, 0] = self.action_history[active, step_idx]
+
+  def sim_step(self, step_idx: int, active: np.ndarray) -> None:
+    window = slice(step_idx - CONTEXT_LENGTH + 1, step_idx + 1)
+    preds = self.sim_model.get_current_lataccels_from_tokens(
+      sim_inputs=self.sim_inputs[active, window],
+      past_tokens=self.tokens[active, step_idx - CONTEXT_LENGTH:step_idx],
+      rngs=[self.rngs[i] for i in active]
+    )
+    current = self.current_lataccel[active]
+    preds = np.clip(preds, current - MAX_ACC_DELTA, current + MAX_ACC_DELTA)
+    if step_idx >= CONTROL_START_IDX:
+      self.current_lataccel[active] = preds
+    else:
+      self.current_lataccel[active] = self.target_lataccel[active, step_idx]
+    self.current_lataccel_history[active, step_idx] = self.current_lataccel[active]
+    self.tokens[active, step_idx] = self.sim_model.tokenizer.encode(self.current_lataccel[active])
+    self.cost_accumulator.update(step_idx, self.target_lataccel[active, step_idx], self.current_lataccel[active],
+                                 self.current_lataccel_history[active, step_idx - 1], rows=active)
+
+  def step(self) -> None:
+    active = np.flatnonzero((self.lengths > self.step_idx) & (self.pruned_at == 0))
+    self.control_step(self.step_idx, active)
+    self.sim_step(self.step_idx, active)
+    self.step_idx += 1
+
+  def compute_cost(self) -> List[Dict[str, float]]:
+    return [
+      self.cost_accumulator.pruned_cost(self.pruned_at[i], row=i) if self.pruned_at[i]
+      else get_cost(self.target_lataccel[i, :n], self.current_lataccel_history[i, :n])
+      for i, n in enumerate(self.lengths)
+    ]
+
+  def stream(self, every: int = 1, stop_at_cost_end: bool = False) -> Iterator[Tuple[int, Dict[str, np.ndarray]]]:
+    """
+    Steps the batch, yielding (step_idx, per-row costs so far as [B] arrays) every `every` steps and after the last one.
+    """
+    end = min(self.lengths.max(), COST_END_IDX) if stop_at_cost_end else self.lengths.max()
+    for _ in range(CONTEXT_LENGTH, end):
+      self.step()
+      if (self.step_idx - CONTEXT_LENGTH) % every == 0 or self.step_idx == end:
+        yield self.step_idx, self.cost_accumulator.partial_cost()
+
+  def rollout(self, cost_budget: float = None, stop_at_cost_end: bool = False) -> List[Dict[str, float]]:
+    """
+    Args:
+      cost_budget: rows whose total_cost is certain to exceed it stop stepping and get a record marked 'pruned'.
+      stop_at_cost_end: skip the steps after COST_END_IDX, which do not count towards the cost.
+    """
+    end = min(self.lengths.max(), COST_END_IDX) if stop_at_cost_end else self.lengths.max()
+    for _ in range(CONTEXT_LENGTH, end):
+      self.step()
+      if cost_budget is not None:
+        bound = self.cost_accumulator.lower_bound()['total_cost']
+        self.pruned_at[(self.pruned_at == 0) & (bound > cost_budget)] = self.step_idx
+        if self.pruned_at.all():
+          break
+    return self.compute_cost()
+
+
 def get_available_controllers():
   return [f.stem for f in Path('controllers').iterdir() if f.is_file() and f.suffix == '.py' and f.stem != '__init__']
 
 
-def run_rollout(data_path, controller_type, model_path, debug=False):
-  tinyphysicsmodel = TinyPhysicsModel(model_path, debug=debug)
+models: Dict[str, TinyPhysicsModel] = {}
+
+
+def get_model(model_path: str, **model_options) -> TinyPhysicsModel:
+  # one model per process: building the ORT session is far more expensive than a rollout step.
+  # the first call in a process decides the options (backend, threads, ...) of its model
+  if model_path not in models:
+    models[model_path] = TinyPhysicsModel(model_path, debug=False, **model_options)
+  return models[model_path]
+
+
+def init_worker(model_path: str, model_options: dict, segments: SharedSegmentStore = None) -> None:
+  get_model(model_path, **model_options)
+  if segments is not None:
+    use_shared_segments(segments)
+
+
+class RolloutPool:
+  """
+  Persistent process pool whose workers load the model once at startup and reuse it for every rollout.
+  Results come back in submission order, and rollouts are seeded per segment, so they are deterministic.
+  With segments (a SharedSegmentStore), workers attach to it at startup and load those segments from shared memory.
+  """
+  def __init__(self, model_path: str, max_workers: int = None, segments: SharedSegmentStore = None, **model_options) -> None:
+    self.model_path = model_path
+    self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(model_path, model_options, segments))
+
+  def map(self, fn, items: list, chunksize: int = 1, desc: str = None) -> list:
+    return list(tqdm(self.executor.map(fn, items, chunksize=chunksize), total=len(items), desc=desc))
+
+  def close(self) -> None:
+    self.executor.shutdown()
+
+  def __enter__(self) -> 'RolloutPool':
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+
+def run_rollout(data_path, controller_type, model_path, debug=False, profile=False, cost_budget=None, future_plan_lists=True):
+  tinyphysicsmodel = get_model(model_path)
   controller = importlib.import_module(f'controllers.{controller_type}').Controller()
-  sim = TinyPhysicsSimulator(tinyphysicsmodel, str(data_path), controller=controller, debug=debug)
-  return sim.rollout(), sim.target_lataccel_history, sim.current_lataccel_history
+  sim = TinyPhysicsSimulator(tinyphysicsmodel, str(data_path), controller=controller, debug=debug, future_plan_lists=future_plan_lists)
+  if not profile:
+    return sim.rollout(cost_budget=cost_budget), sim.target_lataccel_history, sim.current_lataccel_history
+  profiler = StepProfiler().attach(sim)
+  try:
+    cost = sim.rollout(cost_budget=cost_budget)
+  finally:
+    profiler.detach()
+  return cost, sim.target_lataccel_history, sim.current_lataccel_history, profiler.record()
+
+
+def get_batch_controller(controller_type: str, batch_size: int) -> Union[List[BaseController], BaseBatchController]:
+  # the module's vectorized BatchController when it has one, otherwise one Controller per row
+  module = importlib.import_module(f'controllers.{controller_type}')
+  if hasattr(module, 'BatchController'):
+    return module.BatchController(batch_size)
+  return [module.Controller() for _ in range(batch_size)]
+
+
+def run_batched_rollout(data_paths, controller_type, model_path, cost_budget=None, future_plan_lists=True):
+  tinyphysicsmodel = get_model(model_path)
+  sim = BatchedTinyPhysicsSimulator(tinyphysicsmodel, [str(p) for p in data_paths], controllers=get_batch_controller(controller_type, len(data_paths)),
+                                    future_plan_lists=future_plan_lists)
+  costs = sim.rollout(cost_budget=cost_budget)
+  return [(cost, sim.target_lataccel[i, :n], sim.current_lataccel_history[i, :n]) for i, (cost, n) in enumerate(zip(costs, sim.lengths))]
+
+
+def summarize_costs(costs: List[float], quantiles=(5, 25, 50, 75, 95)) -> Dict[str, float]:
+  costs = np.asarray(costs, dtype=np.float64)
+  summary = {'mean': float(costs.mean()), 'std': float(costs.std(ddof=1)) if len(costs) > 1 else 0.0}
+  summary.update({f'p{q}': float(v) for q, v in zip(quantiles, np.percentile(costs, quantiles))})
+  return summary
+
+
+def run_monte_carlo_rollout(data_path, controller_type, model_path, replicas=16, future_plan_lists=True):
+  """
+  Runs `replicas` stochastic rollouts of one segment as a single batch: the segment is loaded once, every step is
+  one model call for all replicas, and each replica samples from its own seed stream (replica 0 is run_rollout's).
+  Returns the per-replica costs and mean/std/quantiles of each cost.
+  """
+  tinyphysicsmodel = get_model(model_path)
+  data_path = str(data_path)
+  sim = BatchedTinyPhysicsSimulator(tinyphysicsmodel, [data_path] * replicas, controllers=get_batch_controller(controller_type, replicas),
+                                    seeds=[get_replica_seed(data_path, k) for k in range(replicas)], future_plan_lists=future_plan_lists)
+  costs = sim.rollout(stop_at_cost_end=True)
+  return {
+    'segment': data_path,
+    'replicas': replicas,
+    'costs': costs,
+    **{name: summarize_costs([cost[name] for cost in costs]) for name in ['lataccel_cost', 'jerk_cost', 'total_cost']},
+  }
+
+
+def run_rollouts(files, controller_type, model_path, workers=None, batch_size=1, profile=False, future_plan_lists=True, **model_options):
+  # directory mode: every segment on one persistent pool, batch_size segments per model call
+  with RolloutPool(model_path, max_workers=workers, **model_options) as pool:
+    if batch_size > 1:
+      run_batched_rollout_partial = partial(run_batched_rollout, controller_type=controller_type, model_path=model_path, future_plan_lists=future_plan_lists)
+      batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+      return [result for batch in pool.map(run_batched_rollout_partial, batches) for result in batch]
+    run_rollout_partial = partial(run_rollout, controller_type=controller_type, model_path=model_path, debug=False, profile=profile,
+                                  future_plan_lists=future_plan_lists)
+    return pool.map(run_rollout_partial, files, chunksize=10)
 
 
 def download_dataset():
+  from dataset import download_dataset as download
+
   print("Downloading dataset (0.6G)...")
-  DATASET_PATH.mkdir(parents=True, exist_ok=True)
-  with urllib.request.urlopen(DATASET_URL) as resp:
-    with zipfile.ZipFile(BytesIO(resp.read())) as z:
-      for member in z.namelist():
-        if not member.endswith('/'):
-          with z.open(member) as src, open(DATASET_PATH / os.path.basename(member), 'wb') as dest:
-            dest.write(src.read())
+  download(DATASET_URL, DATASET_PATH)
 
 
 if __name__ == "__main__":
@@ -241,22 +758,49 @@ if __name__ == "__main__":
   parser.add_argument("--model_path", type=str, required=True)
   parser.add_argument("--data_path", type=str, required=True)
   parser.add_argument("--num_segs", type=int, default=100)
+  parser.add_argument("--batch_size", type=int, default=1, help="segments stepped together per model call in directory mode")
+  parser.add_argument("--workers", type=int, default=os.cpu_count(), help="rollout worker processes in directory mode")
+  parser.add_argument("--backend", default='ort', choices=['ort', 'numpy'])
+  parser.add_argument("--threads", type=int, default=1, help="intra-op threads per ORT session")
   parser.add_argument("--debug", action='store_true')
+  parser.add_argument("--profile", action='store_true', help="time each phase of the sim step and print a report")
   parser.add_argument("--controller", default='pid', choices=available_controllers)
+  parser.add_argument("--results", type=str, default=None, help="SQLite results store to record per-segment costs in (directory mode)")
+  parser.add_argument("--future_plan_arrays", action='store_true', help="pass future_plan fields as read-only ndarrays instead of lists")
   args = parser.parse_args()
+  if args.profile and args.batch_size > 1:
+    parser.error("--profile is only supported with --batch_size 1")
 
   if not DATASET_PATH.exists():
     download_dataset()
 
+  model_options = {'backend': args.backend}
+  if args.backend == 'ort':
+    model_options['intra_op_num_threads'] = args.threads
+
   data_path = Path(args.data_path)
   if data_path.is_file():
-    cost, _, _ = run_rollout(data_path, args.controller, args.model_path, debug=args.debug)
+    get_model(args.model_path, **model_options)
+    cost, _, _, *profile = run_rollout(data_path, args.controller, args.model_path, debug=args.debug, profile=args.profile,
+                                       future_plan_lists=not args.future_plan_arrays)
+    if args.profile:
+      print(profile_report(profile))
     print(f"\nAverage lataccel_cost: {cost['lataccel_cost']:>6.4}, average jerk_cost: {cost['jerk_cost']:>6.4}, average total_cost: {cost['total_cost']:>6.4}")
   elif data_path.is_dir():
-    run_rollout_partial = partial(run_rollout, controller_type=args.controller, model_path=args.model_path, debug=False)
     files = sorted(data_path.iterdir())[:args.num_segs]
-    results = process_map(run_rollout_partial, files, max_workers=16, chunksize=10)
+    results = run_rollouts(files, args.controller, args.model_path, workers=args.workers, batch_size=args.batch_size, profile=args.profile,
+                           future_plan_lists=not args.future_plan_arrays, **model_options)
+    if args.profile:
+      print(profile_report([result[3] for result in results]))
     costs = [result[0] for result in results]
+    if args.results:
+      from results_store import ResultsStore, get_controller_hash, get_model_hash
+
+      with ResultsStore(args.results) as store:
+        store.put_many(args.controller, get_controller_hash(args.controller), get_model_hash(args.model_path, **model_options), zip(map(str, files), costs))
+    import pandas as pd
+
+    plt = get_pyplot()
     costs_df = pd.DataFrame(costs)
     print(f"\nAverage lataccel_cost: {np.mean(costs_df['lataccel_cost']):>6.4}, average jerk_cost: {np.mean(costs_df['jerk_cost']):>6.4}, average total_cost: {np.mean(costs_df['total_cost']):>6.4}")
     for cost in costs_df.columns:
@@ -0,0 +1,183 @@
+"""
+Gain tuner for controllers/feedforwardPid.py: CMA-ES over p/i/d and the feed-forward gains, scored by the mean
+total_cost over a set of segments. Writes the best gains as a ready-to-use controller.
+
+  python tune.py --model_path ./models/tinyphysics.onnx --data_path ./data --num_segs 100 --output controllers/tunedPid.py
+
+Each generation is one task per segment on a persistent RolloutPool: a worker rolls out every candidate on its
+segment as one batch (one model call per step for all of them). Reports candidate-rollouts/sec.
+"""
+import argparse
+import importlib
+import os
+import numpy as np
+
+from contextlib import nullcontext
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List
+
+from controllers.feedforwardPid import GAIN_NAMES, HORIZON, BatchController
+from segment_cache import SharedSegmentStore
+from tinyphysics import BatchedTinyPhysicsSimulator, RolloutPool, get_available_controllers, get_model
+
+# typical magnitude of each gain: the search steps are sigma * SCALES
+SCALES = {'p': 0.1, 'i': 0.03, 'd': 0.1, 'ff': 0.1, 'ff_future': 0.1, 'ff_roll': 0.1}
+
+TEMPLATE = '''from .feedforwardPid import BatchController as FeedforwardBatchController, Controller as FeedforwardController
+
+# tuned by tune.py on {num_segs} segments of {data_path}: mean total_cost {cost:.4f} (initial gains: {init_cost:.4f})
+GAINS = {gains!r}
+HORIZON = {horizon}
+
+
+class Controller(FeedforwardController):
+  """
+  PID + feed-forward controller with tuned gains
+  """
+  def __init__(self):
+    super().__init__(horizon=HORIZON, **GAINS)
+
+
+class BatchController(FeedforwardBatchController):
+  def __init__(self, batch_size):
+    super().__init__(batch_size, horizon=HORIZON, **GAINS)
+'''
+
+
+class CMAES:
+  """
+  (mu/mu_w, lambda)-CMA-ES with the default strategy parameters (Hansen, "The CMA Evolution Strategy: A Tutorial").
+  Minimizes; ask() returns [popsize, n] candidates and tell() takes their costs.
+  """
+  def __init__(self, mean: np.ndarray, sigma: float, popsize: int, seed: int = 0) -> None:
+    n = len(mean)
+    self.mean, self.sigma, self.popsize = np.asarray(mean, dtype=np.float64), sigma, popsize
+    self.rng = np.random.RandomState(seed)
+    self.mu = popsize // 2
+    weights = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+    self.weights = weights / weights.sum()
+    self.mueff = 1 / np.sum(self.weights ** 2)
+    self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+    self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+    self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+    self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+    self.damps = 1 + 2 * max(0, np.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+    self.chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+    self.pc, self.ps = np.zeros(n), np.zeros(n)
+    self.C = np.eye(n)
+    self.generation = 0
+
+  def ask(self) -> np.ndarray:
+    eigenvalues, self.B = np.linalg.eigh(self.C)
+    self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+    z = self.rng.standard_normal((self.popsize, len(self.mean)))
+    return self.mean + self.sigma * (z * self.D) @ self.B.T
+
+  def tell(self, candidates: np.ndarray, costs: np.ndarray) -> None:
+    n = len(self.mean)
+    selected = candidates[np.argsort(costs, kind='stable')[:self.mu]]
+    old_mean = self.mean
+    self.mean = self.weights @ selected
+    y = (self.mean - old_mean) / self.sigma
+    inv_sqrt_C = self.B @ np.diag(1 / self.D) @ self.B.T
+    self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * inv_sqrt_C @ y
+    self.generation += 1
+    hsig = np.linalg.norm(self.ps) / np.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) / self.chi_n < 1.4 + 2 / (n + 1)
+    self.pc = (1 - self.cc) * self.pc + hsig * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * y
+    steps = (selected - old_mean) / self.sigma
+    self.C = ((1 - self.c1 - self.cmu) * self.C
+              + self.c1 * (np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.C)
+              + self.cmu * (steps.T * self.weights) @ steps)
+    self.sigma *= np.exp((self.cs / self.damps) * (np.linalg.norm(self.ps) / self.chi_n - 1))
+
+
+def rollout_candidates(task) -> np.ndarray:
+  # worker task: every candidate on one segment, one row each, stepped together
+  model_path, data_path, gains, horizon = task
+  num_candidates = len(next(iter(gains.values())))
+  controller = BatchController(num_candidates, horizon=horizon, **gains)
+  sim = BatchedTinyPhysicsSimulator(get_model(model_path), [data_path] * num_candidates, controller)
+  return np.array([cost['total_cost'] for cost in sim.rollout(stop_at_cost_end=True)])
+
+
+def evaluate(pool: RolloutPool, model_path: str, files: List[str], candidates: List[Dict[str, float]], horizon: int, desc: str = None) -> np.ndarray:
+  """
+  Mean total_cost of each candidate gain set over files.
+  """
+  gains = {name: np.array([candidate[name] for candidate in candidates]) for name in GAIN_NAMES}
+  costs = pool.map(rollout_candidates, [(model_path, data_path, gains, horizon) for data_path in files], desc=desc)
+  return np.mean(costs, axis=0)
+
+
+def get_gains(controller_type: str) -> Dict[str, float]:
+  # a controller's gains as a starting point; feed-forward gains it does not have are 0
+  controller = importlib.import_module(f'controllers.{controller_type}').Controller()
+  return {name: float(getattr(controller, name, 0.0)) for name in GAIN_NAMES}
+
+
+def write_controller(path: str, gains: Dict[str, float], horizon: int, cost: float, init_cost: float, data_path: str, num_segs: int) -> None:
+  Path(path).write_text(TEMPLATE.format(gains=gains, horizon=horizon, cost=cost, init_cost=init_cost, data_path=data_path, num_segs=num_segs))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--model_path", type=str, required=True)
+  parser.add_argument("--data_path", type=str, required=True)
+  parser.add_argument("--num_segs", type=int, default=100)
+  parser.add_argument("--workers", type=int, default=os.cpu_count(), help="rollout worker processes")
+  parser.add_argument("--backend", default='ort', choices=['ort', 'numpy'])
+  parser.add_argument("--threads", type=int, default=1, help="intra-op threads per ORT session")
+  parser.add_argument("--init", default='pid', choices=get_available_controllers(), help="controller whose gains the search starts from")
+  parser.add_argument("--tune", nargs='+', default=GAIN_NAMES, choices=GAIN_NAMES, help="gains to search, the rest stay at --init's")
+  parser.add_argument("--horizon", type=int, default=HORIZON, help="future_plan frames averaged by the lookahead term")
+  parser.add_argument("--popsize", type=int, default=16, help="candidates per generation")
+  parser.add_argument("--generations", type=int, default=20)
+  parser.add_argument("--sigma", type=float, default=0.5, help="initial step size, in units of each gain's typical scale")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--no_shared_segments", action='store_true', help="workers load segments themselves instead of from shared memory")
+  parser.add_argument("--output", type=str, default="controllers/tunedPid.py", help="controller file to write the best gains to")
+  args = parser.parse_args()
+
+  model_options = {'backend': args.backend}
+  if args.backend == 'ort':
+    model_options['intra_op_num_threads'] = args.threads
+
+  files = [str(f) for f in sorted(Path(args.data_path).iterdir())[:args.num_segs]]
+  init = get_gains(args.init)
+  scales = np.array([SCALES[name] for name in args.tune])
+  # the search runs in units of each gain's scale, centred on the initial gains
+  origin = np.array([init[name] for name in args.tune])
+
+  def to_gains(x: np.ndarray) -> Dict[str, float]:
+    return {**init, **{name: float(value) for name, value in zip(args.tune, origin + x * scales)}}
+
+  es = CMAES(np.zeros(len(args.tune)), args.sigma, args.popsize, seed=args.seed)
+  rollouts, seconds = 0, 0.0
+  # every generation rolls out the same segments: they are parsed once and read by the workers from shared memory
+  with SharedSegmentStore.create(files) if not args.no_shared_segments else nullcontext() as segments, \
+       RolloutPool(args.model_path, max_workers=min(args.workers, len(files)), segments=segments, **model_options) as pool:
+    for generation in range(args.generations):
+      xs = es.ask()
+      candidates = [to_gains(x) for x in xs]
+      if generation == 0:
+        # the initial gains ride along with the first generation
+        candidates.append(init)
+      start = perf_counter()
+      costs = evaluate(pool, args.model_path, files, candidates, args.horizon, desc=f"Generation {generation}")
+      elapsed = perf_counter() - start
+      rollouts, seconds = rollouts + len(candidates) * len(files), seconds + elapsed
+      if generation == 0:
+        init_cost, costs = costs[-1], costs[:-1]
+        best_cost, best_gains = init_cost, init
+      es.tell(xs, costs)
+      if costs.min() < best_cost:
+        best_cost, best_gains = float(costs.min()), candidates[int(costs.argmin())]
+      print(f"generation {generation:>3}: best {costs.min():>8.4f}  median {np.median(costs):>8.4f}  best so far {best_cost:>8.4f}  "
+            f"sigma {es.sigma:.3f}  {len(candidates) * len(files) / elapsed:>7.1f} candidate-rollouts/s")
+
+  write_controller(args.output, best_gains, args.horizon, best_cost, init_cost, args.data_path, len(files))
+  print(f"initial gains ({args.init}): {init_cost:.4f}, best: {best_cost:.4f}")
+  print("gains: " + ", ".join(f"{name}={value:.6g}" for name, value in best_gains.items()))
+  print(f"{rollouts} candidate rollouts in {seconds:.1f} s: {rollouts / seconds:.1f} candidate-rollouts/s")
+  print(f"Controller written to '{args.output}'")